@@ -1 +1 @@
-__all__ = ['redshift','controller','local_settings','upbound']
+__all__ = ['redshift','controller','local_settings','upbound','manifest','watermark','planner','chunkfile','benchmark','diffsync','pgbinary','scheduler','connections','snapshot','jsonfile']
\ No newline at end of file
@@ -0,0 +1,183 @@
+"""Throughput benchmarks for the mirror, run against local postgres databases standing in for both redshift and the upload database.
+
+Example:
+    python -m action_network_mirror_mirror.benchmark --host localhost --user postgres --rows 200000 --subtables 3 --out bench.jsonl
+    python -m action_network_mirror_mirror.benchmark --compare before.jsonl after.jsonl
+
+Each stage of each table class is written as one json line to --out, so runs can be compared with --compare."""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+import psycopg2 as pg
+from .controller import Controller
+from .chunkfile import suffixes
+from .manifest import Manifest
+from .local_settings import working_directory as wd
+from .log import log, total
+
+source_db = 'mirror_bench_source'
+target_db = 'mirror_bench_target'
+
+#synthetic table classes in the shape of the Action Network tables: name -> column definitions.  signatures and field_values are immutable, donations mutable.
+bench_tables = {
+    'signatures': "id integer, created_at timestamp, updated_at timestamp, petition_id integer, user_id integer, email character varying (255), comments character varying (1000)",
+    'field_values': "id integer, created_at timestamp, updated_at timestamp, user_id integer, name character varying (255), value character varying (255)",
+    'donations': "id integer, created_at timestamp, updated_at timestamp, user_id integer, amount numeric(12,2), currency character varying (3), status character varying (32)",
+}
+
+bench_values = {
+    'signatures': "g, {created}, {created} + interval '1 hour', g % 5000, g % 1000003, 'user' || (g % 1000003) || '@example.org', repeat('x', g % 200)",
+    'field_values': "g, {created}, {created}, g % 1000003, 'field_' || (g % 50), md5(g::text)",
+    'donations': "g, {created}, {created} + (g % 30) * interval '1 day', g % 1000003, (g % 50000) / 100.0, 'USD', CASE WHEN g % 7 = 0 THEN 'refunded' ELSE 'completed' END",
+}
+
+#stand-ins for the redshift-only trunc() and the merge functions installed in the real upload database
+source_functions = ["CREATE FUNCTION public.trunc(timestamp) RETURNS date AS 'SELECT $1::date' LANGUAGE sql IMMUTABLE"]
+target_functions = [
+    """CREATE FUNCTION update_from_staging(t text) RETURNS void AS $$ BEGIN
+        EXECUTE format('INSERT INTO redshift.%I SELECT s.* FROM redshift_staging.%I s WHERE NOT EXISTS (SELECT 1 FROM redshift.%I r WHERE r.id = s.id)', t, t, t);
+        EXECUTE format('DELETE FROM redshift_staging.%I', t); END $$ LANGUAGE plpgsql""",
+    """CREATE FUNCTION update_mutable_from_staging(t text) RETURNS void AS $$ BEGIN
+        EXECUTE format('DELETE FROM redshift.%I r USING redshift_staging.%I s WHERE r.id = s.id', t, t);
+        EXECUTE format('INSERT INTO redshift.%I SELECT * FROM redshift_staging.%I', t, t);
+        EXECUTE format('DELETE FROM redshift_staging.%I', t); END $$ LANGUAGE plpgsql""",
+    """CREATE FUNCTION update_nodate_from_staging(t text) RETURNS void AS $$ BEGIN
+        PERFORM update_mutable_from_staging(t); END $$ LANGUAGE plpgsql""",
+]
+
+def settings_for(server,dbname):
+    settings = dict(server)
+    settings['dbname'] = dbname
+    return settings
+
+def execute_all(settings,statements,autocommit=False):
+    conn = pg.connect(**settings)
+    conn.autocommit = autocommit
+    curs = conn.cursor()
+    for statement in statements:
+        curs.execute(statement)
+    if not autocommit:
+        conn.commit()
+    conn.close()
+
+def build(server,rows,subtables,days=365,bulk_fraction=0.2):
+    """(Re)create the source and target databases and fill the source with synthetic data.
+    Each table class gets a master table and subtables _1 to _N of the given number of rows each, spread over the given number of days, except that bulk_fraction of them fall on a single day as after a bulk import."""
+    log('building benchmark databases with %s subtables of %s rows' % (subtables,rows))
+    admin = settings_for(server,server.get('dbname') or 'postgres')
+    execute_all(admin,['DROP DATABASE IF EXISTS %s' % source_db,'DROP DATABASE IF EXISTS %s' % target_db,'CREATE DATABASE %s' % source_db,'CREATE DATABASE %s' % target_db],autocommit=True)
+    statements = source_functions + ['CREATE SCHEMA group_64154_indexed','ALTER DATABASE %s SET search_path = group_64154_indexed, public' % source_db]
+    created = "CASE WHEN g %% 100 < %d THEN timestamp '2019-06-01' + (g %% 86400) * interval '1 second' ELSE timestamp '2018-01-01' + (g %% %d) * interval '1 day' + (g %% 86400) * interval '1 second' END" % (int(bulk_fraction * 100),days)
+    for (table, columns) in bench_tables.items():
+        for (n, name) in enumerate([table] + ['%s_%s' % (table,i) for i in range(1,subtables + 1)]):
+            statements.append('CREATE TABLE group_64154_indexed.%s (%s)' % (name,columns))
+            statements.append('INSERT INTO group_64154_indexed.%s SELECT %s FROM generate_series(%d, %d) g' % (name,bench_values[table].format(created=created),n * rows + 1,(n + 1) * rows))
+    execute_all(settings_for(server,source_db),statements)
+    targets = target_functions + ['CREATE SCHEMA redshift','CREATE SCHEMA redshift_staging','ALTER DATABASE %s SET search_path = redshift, public' % target_db]
+    for (table, columns) in bench_tables.items():
+        targets.append('CREATE TABLE redshift.%s (%s)' % (table,columns))
+        targets.append('CREATE TABLE redshift_staging.%s (%s)' % (table,columns))
+    execute_all(settings_for(server,target_db),targets)
+
+#stages of the real sync recorded as log events, and the tables they are recorded under: chunk downloads under the subtable, loads under the table class
+download_stages = ['fetch','write']
+upload_stages = ['copy','merge']
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def stage_result(stage,seconds,rows,bytes,peak_rss,**fields):
+    fields.update({'stage':stage,'rows':rows,'bytes':bytes,'seconds':round(seconds,4),
+                   'rows_per_sec':round(rows / seconds,1) if seconds else None,
+                   'bytes_per_sec':round(bytes / seconds,1) if seconds else None,
+                   'peak_rss_kb':peak_rss})
+    return fields
+
+def run(server,max_chunk=100000,fetch_size=None,compression=None,merge_group=1,tables=None):
+    """Sync each benchmark table class from the source to the target database with the real Downloader and Controller.upload_all, and return a list of result dicts, one per table class and stage.
+    Chunk planning is timed directly, by planning each subtable with plan_chunks before downloading that plan, and the other stages are read from the performance events the sync records.
+    Fetch and write are interleaved, as are copy and merge, so they are timed separately but share a peak_rss_kb: the process' peak resident memory once the stage is over.
+    Since that peak never falls, the stage which raises it is the one using the memory."""
+    source = settings_for(server,source_db)
+    target = settings_for(server,target_db)
+    c = Controller(compression=compression,source=source,target=target,merge_group=merge_group)
+    if fetch_size:
+        c.dl.fetch_size = fetch_size
+    run_id = datetime.now().isoformat()
+    results = []
+    for table in tables or list(bench_tables):
+        common = {'run':run_id,'table':table,'max_chunk':max_chunk,'fetch_size':c.dl.fetch_size,'compression':compression,'merge_group':merge_group}
+        subtables = c.dl.model.list_subtables(table)
+        def totals():
+            return dict([(stage,(total(subtables,stage,'seconds'),total(subtables,stage,'rows'),total(subtables,stage,'bytes'))) for stage in download_stages] +
+                        [(stage,(total([table],stage,'seconds'),total([table],stage,'rows'),total([table],stage,'bytes'))) for stage in upload_stages])
+        before = totals()
+        started = time.perf_counter()
+        plans = dict([(subtable,c.dl.plan_chunks(subtable,max_chunk=max_chunk)) for subtable in subtables])
+        planned = time.perf_counter()
+        rss = {'plan':peak_rss_kb()}
+        for subtable in subtables:
+            c.dl.maxchunk_download(subtable,max_chunk=max_chunk,segments=plans[subtable])
+        rss.update(dict([(stage,peak_rss_kb()) for stage in download_stages]))
+        c.upload_all(table)
+        finished = time.perf_counter()
+        rss.update(dict([(stage,peak_rss_kb()) for stage in upload_stages]))
+        after = totals()
+        stages = dict([(stage,[a - b for (a, b) in zip(after[stage],before[stage])]) for stage in after])
+        results.append(stage_result('plan',planned - started,sum([s.rows for p in plans.values() for s in p]),0,rss['plan'],**common))
+        for stage in download_stages + upload_stages:
+            results.append(stage_result(stage,*stages[stage],rss[stage],**common))
+        results.append(stage_result('total',finished - started,stages['merge'][1] or stages['copy'][1],stages['write'][2],peak_rss_kb(),**common))
+        for subtable in subtables:
+            manifest = Manifest(subtable)
+            for fname in c.chunk_files(subtable):
+                os.remove(wd + fname)
+            os.remove(manifest.path)
+    return results
+
+def compare(before,after):
+    """Print the change in rows/sec for each table and stage between two benchmark result files."""
+    def rates(fname):
+        with open(fname,'rt') as src:
+            return dict([((r['table'],r['stage']),r['rows_per_sec']) for r in map(json.loads,src) if 'table' in r])
+    old = rates(before)
+    new = rates(after)
+    for key in sorted(set(old) & set(new)):
+        if old[key] and new[key]:
+            print('%-14s %-11s %12.1f -> %12.1f rows/sec (%+.1f%%)' % (key[0],key[1],old[key],new[key],100.0 * (new[key] - old[key]) / old[key]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the mirror against local postgres stand-ins for redshift and the upload database.')
+    parser.add_argument('--host',default='localhost')
+    parser.add_argument('--port',type=int,default=5432)
+    parser.add_argument('--user',default='postgres')
+    parser.add_argument('--password',default='')
+    parser.add_argument('--rows',type=int,default=100000,help='rows per subtable')
+    parser.add_argument('--subtables',type=int,default=2)
+    parser.add_argument('--max-chunk',type=int,default=100000)
+    parser.add_argument('--fetch-size',type=int)
+    parser.add_argument('--compression',choices=sorted(suffixes))
+    parser.add_argument('--merge-group',type=int,default=1,help='chunk files loaded into staging per merge; 0 for all of a subtable')
+    parser.add_argument('--skip-build',action='store_true',help='reuse the databases from a previous run')
+    parser.add_argument('--out',help='append json lines results to this file rather than printing them')
+    parser.add_argument('--compare',nargs=2,metavar=('BEFORE','AFTER'),help='compare two results files and exit')
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    server = {'host':args.host,'port':args.port,'user':args.user,'password':args.password,'dbname':'postgres'}
+    if not args.skip_build:
+        build(server,args.rows,args.subtables)
+    results = run(server,max_chunk=args.max_chunk,fetch_size=args.fetch_size,compression=args.compression,merge_group=args.merge_group or None)
+    sink = open(args.out,'at') if args.out else sys.stdout
+    for result in results:
+        sink.write(json.dumps(result) + '\n')
+    if args.out:
+        sink.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import gzip
+import hashlib
+import io
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#file name suffix for each supported chunk compression format
+suffixes = {'gzip':'.gz','zstd':'.zst'}
+#favour speed over ratio; the chunk files are scratch data and downloads should not become cpu bound
+gzip_level = 1
+zstd_level = 3
+
+def compression_of(fname):
+    """Return the compression format of a chunk file, judging by its name, or None if it is plain csv."""
+    for (compression, suffix) in suffixes.items():
+        if fname.endswith(suffix):
+            return compression
+    return None
+
+def strip_suffix(fname):
+    """Return a chunk file name without any compression suffix."""
+    compression = compression_of(fname)
+    if compression is None:
+        return fname
+    return fname[:-len(suffixes[compression])]
+
+class Digest():
+    """Running size and md5 checksum of the bytes written to a chunk file, in the form recorded in its manifest, so the file need not be read back to compute them."""
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.bytes = 0
+
+    def summary(self):
+        return (self.bytes, self.md5.hexdigest())
+
+class DigestingFile(io.RawIOBase):
+    """Binary file opened for writing which passes everything written through a Digest."""
+    def __init__(self,path,digest):
+        self.sink = open(path,'wb')
+        self.digest = digest
+
+    def writable(self):
+        return True
+
+    def write(self,data):
+        self.digest.md5.update(data)
+        self.digest.bytes += len(data)
+        return self.sink.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.sink.close()
+        super().close()
+
+class DigestingGzipFile(gzip.GzipFile):
+    """GzipFile which also closes the DigestingFile it writes to, as GzipFile leaves file objects it was given open."""
+    def close(self):
+        fileobj = self.fileobj
+        super().close()
+        if fileobj is not None:
+            fileobj.close()
+
+def open_chunk(path,mode='rt',digest=None):
+    """Open a chunk file in text mode as utf-8 csv, compressing or decompressing it on the fly according to its name.  Line endings are left untranslated when writing, as csv.writer supplies its own.
+    If a Digest is given when writing, the size and checksum of the file as stored on disk are accumulated in it."""
+    compression = compression_of(path)
+    newline = None if 'r' in mode else '\n'
+    if digest is not None and 'w' in mode:
+        raw = DigestingFile(path,digest)
+        if compression == 'gzip':
+            return io.TextIOWrapper(DigestingGzipFile(fileobj=raw,mode='wb',compresslevel=gzip_level),encoding='utf-8',newline=newline)
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ImportError('the zstandard package is required to read or write %s' % path)
+            return io.TextIOWrapper(zstandard.ZstdCompressor(level=zstd_level).stream_writer(raw,closefd=True),encoding='utf-8',newline=newline)
+        return io.TextIOWrapper(io.BufferedWriter(raw),encoding='utf-8',newline=newline)
+    if compression == 'gzip':
+        return gzip.open(path,mode,compresslevel=gzip_level,encoding='utf-8',newline=newline)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('the zstandard package is required to read or write %s' % path)
+        return zstandard.open(path,mode,cctx=zstandard.ZstdCompressor(level=zstd_level),encoding='utf-8',newline=newline)
+    return open(path,mode,newline=newline,encoding='utf-8')
@@ -0,0 +1,120 @@
+import psycopg2 as pg
+import random
+import threading
+import time
+from .log import log
+
+#tcp keepalives for every pooled connection, so idle connections are neither dropped by firewalls nor left hanging once the server has gone
+keepalives = {'keepalives':1,'keepalives_idle':60,'keepalives_interval':10,'keepalives_count':5}
+#default bound on the connections open to any one database (raised by reserve where more concurrency is configured), how long an idle connection may sit before it is checked with a trivial query on being leased, and how long to wait for a free connection
+max_connections = 16
+check_after = 30
+lease_timeout = 600
+
+#errors meaning the connection itself has failed, rather than the statement
+connection_errors = (pg.OperationalError, pg.InterfaceError)
+
+def backoff(attempt,base=1.0,cap=60.0):
+    """Return how many seconds to wait before the given (1-based) retry: exponential in the attempt number, capped, with jitter so parallel workers don't retry in step."""
+    return min(cap,base * 2 ** (attempt - 1)) * random.uniform(0.5,1.0)
+
+class ConnectionPool():
+    """Bounded pool of connections to one database, shared by everything connecting with the same settings.
+    Connections are opened with tcp keepalives, and checked before being leased again if they have been idle for a while; broken ones are discarded and replaced."""
+    def __init__(self,settings,maxconn=max_connections):
+        self.settings = settings
+        self.maxconn = maxconn
+        self.idle = []
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def _connect(self):
+        s = self.settings
+        return pg.connect(dbname = s['dbname'], host = s['host'],port=s['port'],user=s['user'],password=s['password'],**keepalives)
+
+    def _healthy(self,conn,idle_since):
+        if conn.closed:
+            return False
+        if time.time() - idle_since < check_after:
+            return True
+        try:
+            curs = conn.cursor()
+            curs.execute('SELECT 1')
+            curs.close()
+            conn.rollback()
+            return True
+        except connection_errors:
+            return False
+
+    def getconn(self):
+        """Lease a connection, reusing a healthy idle one if there is one, otherwise opening a new one.  Blocks while maxconn connections are leased."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.idle or self.size < self.maxconn,timeout=lease_timeout):
+                raise RuntimeError('timed out waiting for one of the %s connections to %s' % (self.maxconn,self.settings['host']))
+            if self.idle:
+                (conn, idle_since) = self.idle.pop()
+            else:
+                (conn, idle_since) = (None, None)
+                self.size += 1
+        if conn is not None and self._healthy(conn,idle_since):
+            return conn
+        if conn is not None:
+            log('discarding a broken connection to %s' % self.settings['host'])
+            self._close(conn)
+        try:
+            return self._connect()
+        except:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def putconn(self,conn,broken=False):
+        """Return a leased connection to the pool, rolling back any open transaction.  Connections which are broken, or fail to roll back, are closed instead."""
+        if not broken and not conn.closed:
+            try:
+                conn.rollback()
+            except connection_errors:
+                broken = True
+        if broken or conn.closed:
+            self._close(conn)
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            return
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def reserve(self,maxconn):
+        """Raise the bound on connections to at least maxconn, so that the configured concurrency can never leave threads holding leases waiting on each other."""
+        with self.cond:
+            if maxconn > self.maxconn:
+                self.maxconn = maxconn
+                self.cond.notify_all()
+
+    def _close(self,conn):
+        try:
+            conn.close()
+        except connection_errors:
+            pass
+
+    def closeall(self):
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+        for (conn, idle_since) in idle:
+            self._close(conn)
+
+#one pool per distinct set of connection settings
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(settings):
+    """Return the pool shared by all connections made with the given settings, creating it on first use."""
+    key = tuple(sorted(settings.items()))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(settings)
+        return pools[key]
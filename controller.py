@@ -1,10 +1,24 @@
 from . import redshift as rs
 from .local_settings import working_directory as wd
 import csv
-from .log import log
+from .log import log, timed, event, summary, write_prometheus, total
 from .upbound import Uploader
+from .manifest import Manifest
+from .watermark import Watermarks, HighWater
+from . import planner
+from . import diffsync
+from . import pgbinary
+from . import scheduler
+from .connections import backoff
+from .snapshot import SnapshotStore
+from .chunkfile import open_chunk, suffixes, strip_suffix, Digest
 from os import listdir
-from datetime import timedelta
+from datetime import timedelta, date, datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time
+import os
+from queue import Queue
 
 #tables where rows are immutable and it's safe to update them by downloading only new records
 valid_partial_tables = ['subscriptions','unsubscriptions','field_values','signatures','deliveries']
@@ -12,71 +26,419 @@ immutables = valid_partial_tables
 no_date_field = ['core_fields_counties','core_fields_ocdids']
 
 class Controller():
-    def __init__(self):
-        self.dl = Downloader()
-        self.up = Uploader()
+    def __init__(self,workers=1,chunk_workers=1,watermark_overlap=timedelta(0),compression=None,source=None,target=None,binary=False,merge_group=1,merge_group_bytes=None,snapshots=False):
+        """workers sets how many subtables of a table class are downloaded concurrently, and chunk_workers how many chunks of each subtable; each concurrent download uses its own redshift connection.
+        watermark_overlap is how far before each table's watermark incremental syncs start, as a safety margin.  compression ('gzip' or 'zstd') is passed on to the Downloader.
+        source and target optionally replace the connection settings of local_settings for the redshift and upload databases.
+        binary makes the streamed transfers (transfer_all, transfer_limited, diff_sync) COPY in postgres' binary format, encoded from the model's column types, rather than csv, for tables whose types allow it.
+        merge_group and merge_group_bytes limit how many chunk files, and how many bytes of them, upload_chunks loads into redshift_staging before each merge and commit.  By default each file is merged on its own;
+        None removes the limit, so merge_group=None with no merge_group_bytes merges each subtable once.  Larger groups mean fewer merges against the main table but longer transactions and a larger staging table.
+        snapshots is passed on to the Downloader, to keep everything downloaded as local parquet snapshots which restore_from_snapshots can load again without touching redshift."""
+        self.dl = Downloader(workers=chunk_workers,compression=compression,settings=source,snapshots=snapshots,max_connections=workers * (chunk_workers + 1) + 1)
+        self.up = Uploader(settings=target)
+        self.workers = workers
+        self.watermarks = Watermarks()
+        self.watermark_overlap = watermark_overlap
+        self.binary = binary
+        self.merge_group = merge_group
+        self.merge_group_bytes = merge_group_bytes
+        self.history = scheduler.History()
     
-    def attempt_download(self,table):
-        """Attempt to use the downloader to retrieve a single table.  Return True on success, False on failure.  Log errors encountered."""
+    def attempt_download(self,table,on_chunk=None):
+        """Attempt to use the downloader to retrieve a single table.  Return True on success, False on failure.  Log errors encountered.  on_chunk, if given, is called with the name of each file as it is completed."""
         if 'created_at' in self.dl.model.list_cols(table) and table != 'donations_recurring_donations':
             func_to_use = self.dl.maxchunk_download
         else:
             func_to_use = self.dl.download
         try:
-            func_to_use(table)
+            with timed('download_subtable',table):
+                func_to_use(table,on_chunk=on_chunk)
             return True
         except Exception as e:
             log('experienced error of type %s while attempting to download %s' % (str(type(e)), table))
             raise e
+        finally:
+            self.dl.release_conn()
 
-    def download_all(self,table):
-        """Attempt to use the downloader to retrieve all of single class of table.  Abort after the 4th failed attempt to retrieve any individual subtable.  Return True if all tables were successfully downloaded, False otherwise."""
-        to_do = self.dl.model.list_subtables(table)
+    def download_all(self,table,on_chunk=None):
+        """Attempt to use the downloader to retrieve all of single class of table, running up to self.workers subtables at once.  Abort after the 4th failed attempt to retrieve any individual subtable.  Return True if all tables were successfully downloaded, False otherwise."""
+        to_do = list(self.dl.model.list_subtables(table))
         failcounters = {}
-        while True:
-            try:
-                curr_subtable = to_do.pop(0)
-                assert self.attempt_download(curr_subtable)
-            except IndexError:
-                break
-            except AssertionError:
-                to_do.append(curr_subtable)
-                try:
-                    failcounters[curr_subtable] = 1
-                except KeyError:
-                    failcounters[curr_subtable] += 1
-                if failcounters[curr_subtable] == 4:
-                    log('repeated failures to download table %s - abandoning attempts' % curr_table)
-                    log('incomplete tables from this set are ' + ', '.join(to_do))
-                    return False
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self.attempt_download,subtable,on_chunk): subtable for subtable in to_do}
+            while pending:
+                done, _ = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    curr_subtable = pending.pop(future)
+                    try:
+                        assert future.result()
+                    except Exception:
+                        failcounters[curr_subtable] = failcounters.get(curr_subtable,0) + 1
+                        if failcounters[curr_subtable] == 4:
+                            log('repeated failures to download table %s - abandoning attempts' % curr_subtable)
+                            for f in pending:
+                                f.cancel()
+                            log('incomplete tables from this set are ' + ', '.join([curr_subtable] + list(pending.values())))
+                            return False
+                        pending[pool.submit(self.attempt_download,curr_subtable,on_chunk)] = curr_subtable
         return True
             
+    def report(self,top=10):
+        """Log a summary of the slowest tables and stages of this run, and update the prometheus textfile if one is configured."""
+        summary(top)
+        write_prometheus()
+
     def dl_manage_list(self,table_list):
         tasks = {}
         for table in table_list:
-            tasks[table] = self.download_all(table)
+            tasks[table] = self.run_recorded(table,self.download_all)
+        return tasks
+
+    def run_recorded(self,table,func):
+        """Run func(table), such as download_all or transfer_limited, adding its duration and the rows fetched to the history the scheduler estimates from.  Return its result."""
+        names = set(self.dl.model.list_subtables(table)) | {table}
+        rows = total(names,'fetch') + total(names,'transfer')
+        started = time.perf_counter()
+        succeeded = False
+        try:
+            result = func(table)
+            succeeded = result is not False
+            return result
+        finally:
+            self.history.record(table,time.perf_counter() - started,total(names,'fetch') + total(names,'transfer') - rows,job=func.__name__,succeeded=succeeded)
+
+    def plan_schedule(self,table_list,func=None,budget=None,deadline=None,priorities=None):
+        """Plan the order in which to run func (download_all by default) on the given table classes, using the history of past runs to estimate their cost, and log the plan with its expected finish time.
+        Tables which are most overdue for their cost come first, and those which would not finish within the budget (a timedelta) or by the deadline (a datetime) are deferred.  Return (scheduled, deferred) as made by scheduler.plan."""
+        job = (func or self.download_all).__name__
+        estimates = dict([(table,self.history.estimate(table,job)) for table in table_list])
+        last_synced = dict([(table,self.history.last_success(table,job)) for table in table_list])
+        (scheduled, deferred) = scheduler.plan(table_list,estimates,last_synced,budget=budget,deadline=deadline,priorities=priorities)
+        scheduler.describe(scheduled,deferred)
+        return (scheduled, deferred)
+
+    def run_schedule(self,table_list,func=None,budget=None,deadline=None,priorities=None,dry_run=False):
+        """Run func (download_all by default) on the given table classes in the order planned by plan_schedule, recording each run in the history.  Tables still to go once the budget or deadline has passed are skipped.
+        With dry_run nothing is run.  Return a dict of table -> the result of func, as dl_manage_list does, for the tables which were run."""
+        func = func or self.download_all
+        (scheduled, deferred) = self.plan_schedule(table_list,func,budget=budget,deadline=deadline,priorities=priorities)
+        tasks = {}
+        if dry_run:
+            return tasks
+        started = datetime.now()
+        limit = min([t for t in [deadline, started + budget if budget is not None else None] if t is not None],default=None)
+        for planned in scheduled:
+            if limit is not None and datetime.now() >= limit:
+                log('out of time - skipping ' + ', '.join([p.table for p in scheduled if p.table not in tasks]))
+                break
+            tasks[planned.table] = self.run_recorded(planned.table,func)
         return tasks
     
     def upload_all(self,table,wd=wd):
+        self.clear_for_upload(table,wd=wd)
+        for subtable in self.dl.model.list_subtables(table):
+            self.upload_chunks(subtable,wd=wd)
+
+    def clear_for_upload(self,table,wd=wd):
+        """Empty a table class ahead of a full reload, unless the manifest of one of its subtables shows an interrupted upload which is about to be resumed."""
+        manifests = [Manifest(subtable,wd=wd) for subtable in self.dl.model.list_subtables(table)]
+        if any([m.partially_uploaded() for m in manifests]):
+            log('resuming an interrupted upload of %s' % table)
+            return
+        for m in manifests:
+            m.reset_uploads()
+        self.up.curs.execute('DELETE FROM redshift.%s' % table)
+        self.up.curs.execute('COMMIT;')
+
+    def upload_chunk(self,subtable,fname,wd=wd):
+        """Upload a single chunk file of a subtable and commit, skipping files the manifest shows as already uploaded and refusing files which don't match it."""
+        manifest = Manifest(subtable,wd=wd)
+        if manifest.uploaded(fname):
+            log('skipping %s - already uploaded' % fname)
+            return
+        verified = manifest.check(fname)
+        self.upload_function(subtable)(fname,self.dl.model.master_table(subtable),wd=wd)
+        self.up.curs.execute('COMMIT;')
+        if verified:
+            manifest.record_upload(fname)
+            if manifest.all_uploaded():
+                self.watermarks.promote(subtable)
+
+    def upload_group(self,subtable,fnames,wd=wd):
+        """Upload a group of chunk files of a subtable with a single merge and commit, skipping files the manifest shows as already uploaded and refusing the group if any file doesn't match it."""
+        manifest = Manifest(subtable,wd=wd)
+        to_load = [f for f in fnames if not manifest.uploaded(f)]
+        if len(to_load) < len(fnames):
+            log('skipping %s files of %s - already uploaded' % (len(fnames) - len(to_load),subtable))
+        if not to_load:
+            return
+        verified = dict([(fname,manifest.check(fname)) for fname in to_load])
+        master_table = self.dl.model.master_table(subtable)
+        self.up.upload_batch(to_load,master_table,self.merge_function(master_table),wd=wd)
+        for fname in to_load:
+            if verified[fname]:
+                manifest.record_upload(fname)
+        if any(verified.values()) and manifest.all_uploaded():
+            self.watermarks.promote(subtable)
+
+    def chunk_groups(self,fnames,wd=wd):
+        """Split a list of chunk files into consecutive groups within the merge_group and merge_group_bytes limits.  A file larger than merge_group_bytes gets a group of its own."""
+        groups = []
+        size = 0
+        for fname in fnames:
+            fsize = os.path.getsize(wd + fname)
+            if groups and (self.merge_group is None or len(groups[-1]) < self.merge_group) and (self.merge_group_bytes is None or size + fsize <= self.merge_group_bytes):
+                groups[-1].append(fname)
+                size += fsize
+            else:
+                groups.append([fname])
+                size = fsize
+        return groups
+
+    def shadow_refresh(self,table,wd=wd):
+        """Fully reload a table class from its downloaded chunk files without readers ever seeing it empty or partly loaded.
+        Only the files recorded in the manifest as written by the current full (.csv) download plan of each subtable are loaded, never chunks of incremental (.csp) downloads which share their names,
+        and only if every segment of the plan has its file and every file matches its manifest.
+        The files are loaded, with no intermediate commits, into a new shadow table made from the data model.  The live table's indexes are then built on the shadow, and the shadow is
+        swapped in by renaming, with the live table's grants, all in the same transaction.  Nothing is changed if any step fails, including if other objects such as views depend on the live table.
+        Once the swap has committed the files are recorded as uploaded and the subtables' watermarks promoted, as upload_chunk does."""
+        shadow = table + '_shadow'
+        curs = self.up.curs
+        curs.execute("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = 'redshift' AND tablename = '%s'" % table)
+        indexes = curs.fetchall()
+        curs.execute("SELECT grantee, privilege_type FROM information_schema.role_table_grants WHERE table_schema = 'redshift' AND table_name = '%s'" % table)
+        grants = curs.fetchall()
+        try:
+            curs.execute('DROP TABLE IF EXISTS redshift.%s' % shadow)
+            curs.execute(self.dl.model.create_statement(table,'redshift',name=shadow))
+            loaded = []
+            with timed('shadow_load',table):
+                for subtable in self.dl.model.list_subtables(table):
+                    manifest = Manifest(subtable,wd=wd)
+                    save_as = subtable + '.csv'
+                    if not manifest.complete(save_as):
+                        raise IOError('the full download of %s is incomplete - refusing to swap in a partial table' % subtable)
+                    fnames = manifest.files(save_as)
+                    for fname in fnames:
+                        manifest.check(fname,required=True)
+                        self.up.upload_file(fname,shadow,wd=wd)
+                    loaded.append((subtable,manifest,fnames))
+            with timed('shadow_index',table):
+                for (name, definition) in indexes:
+                    curs.execute(definition.replace('INDEX %s ON redshift.%s ' % (name,table),'INDEX %s_swap ON redshift.%s ' % (name,shadow)))
+            curs.execute('ALTER TABLE redshift.%s RENAME TO %s_old' % (table,table))
+            curs.execute('ALTER TABLE redshift.%s RENAME TO %s' % (shadow,table))
+            curs.execute('DROP TABLE redshift.%s_old' % table)
+            for (name, definition) in indexes:
+                curs.execute('ALTER INDEX redshift.%s_swap RENAME TO %s' % (name,name))
+            for (grantee, privilege) in grants:
+                curs.execute('GRANT %s ON redshift.%s TO %s' % (privilege,table,grantee if grantee == 'PUBLIC' else '"%s"' % grantee))
+            self.up.connection.commit()
+            log('swapped freshly loaded %s into place' % table)
+        except:
+            self.up.connection.rollback()
+            raise
+        for (subtable, manifest, fnames) in loaded:
+            for fname in fnames:
+                manifest.record_upload(fname)
+            if manifest.all_uploaded():
+                self.watermarks.promote(subtable)
+
+    def upload_function(self,subtable):
+        """Return the Uploader method appropriate for loading chunk files of a subtable."""
+        if self.dl.model.master_table(subtable) in immutables:
+            return self.up.upload_limited
+        elif self.dl.model.master_table(subtable) in no_date_field:
+            return self.up.upload_limited_nodate
+        else:
+            return self.up.upload_limited_mutable
+
+    def pipeline_all(self,table,queue_size=4,wd=wd):
+        """Refresh a whole table class with downloading and uploading overlapped.  Each chunk file is queued for upload as soon as it has been written,
+        and a single uploader thread loads the queue in order, committing after each file as upload_chunks does.  At most queue_size files wait in the queue; downloads block when it is full.
+        Return True if all subtables were downloaded, False otherwise."""
+        self.clear_for_upload(table,wd=wd)
+        chunks = Queue(maxsize=queue_size)
+        errors = []
+        uploader = threading.Thread(target=self._upload_from_queue,args=(chunks,errors,wd))
+        uploader.start()
+        try:
+            downloaded = self.download_all(table,on_chunk=lambda fname: chunks.put(fname))
+        finally:
+            chunks.put(None)
+            uploader.join()
+        if errors:
+            raise errors[0]
+        return downloaded
+
+    def _upload_from_queue(self,chunks,errors,wd=wd):
+        """For internal usage.  Upload chunk files from a queue until a None sentinel is received.  After a failure the queue is still drained, so downloads are never left blocked, and the error is recorded in errors."""
+        while True:
+            fname = chunks.get()
+            if fname is None:
+                break
+            if errors:
+                continue
+            subtable = fname.split('.')[0]
+            try:
+                self.upload_chunk(subtable,fname,wd=wd)
+            except Exception as e:
+                log('experienced error of type %s while uploading %s - skipping remaining chunks' % (str(type(e)), fname))
+                self.up.recover()
+                errors.append(e)
+
+    def merge_function(self,table):
+        """Return the name of the database function used to merge redshift_staging into redshift for a table class."""
+        if table in immutables:
+            return 'update_from_staging'
+        elif table in no_date_field:
+            return 'update_nodate_from_staging'
+        else:
+            return 'update_mutable_from_staging'
+
+    def transfer_all(self,table,max_chunk=5000000):
+        """Refresh a whole table class by streaming each chunk from redshift directly into the upload database, without writing intermediate csv files."""
         self.up.curs.execute('DELETE FROM redshift.%s' % table)
         self.up.curs.execute('COMMIT;')
         for subtable in self.dl.model.list_subtables(table):
-            self.upload_chunks(subtable,wd=wd)
+            self.transfer_queries(table,self.dl.chunk_queries(subtable,max_chunk=max_chunk))
+
+    def transfer_limited(self,table,max_chunk=200000):
+        """Streaming equivalent of limited_download followed by limited_upload."""
+        master_table = self.dl.model.master_table(table)
+        log('attempting a streamed limited update of table %s' % table)
+        if master_table in immutables:
+            date_field = 'created_at'
+        else:
+            date_field = 'updated_at'
+        condition = self.watermark_condition(table,date_field)
+        if condition is None:
+            return
+        high_water = self.dl.high_water(table,date_field)
+        self.transfer_queries(master_table,self.dl.chunk_queries(table,max_chunk=max_chunk,where_clause=' WHERE ' + condition,date_field=date_field,condition=condition),high_water=high_water)
+        if high_water is not None and high_water.mark is not None:
+            self.watermarks.set_pending(table,date_field,high_water.mark)
+            self.watermarks.promote(table)
+
+    def diff_sync(self,table,date_field='updated_at',max_rows=50000,fanout=16):
+        """Bring a table class in the upload database into line with redshift without reloading it.  Fingerprints of id ranges are compared on both sides, ranges which differ are narrowed down to at most max_rows rows,
+        and only those ranges are replaced, each in its own transaction.  The fingerprints include a hash of every column, so rows changed without date_field being bumped are found too.
+        Intended for mutable tables which change little between runs.  Return the number of ranges replaced."""
+        subtables = self.dl.model.list_subtables(table)
+        cols = self.dl.model.list_col_tuples(table)
+        source_cols = [(rs.dereserve(col[0]),col[1]) for col in cols]
+        target_cols = [(rs.renamed(col[0]),col[1]) for col in cols]
+        def source(lo,hi,width):
+            return diffsync.combine([self.dl.conn.fetch(diffsync.fingerprint_query(subtable,lo,hi,width,date_field,source_cols,'redshift')) for subtable in subtables])
+        def target(lo,hi,width):
+            self.up.curs.execute(diffsync.fingerprint_query('redshift.%s' % table,lo,hi,width,date_field,target_cols,'postgres'))
+            return diffsync.combine([self.up.curs.fetchall()])
+        bounds = [self.dl.conn.fetch('SELECT min(id), max(id) FROM %s' % subtable)[0] for subtable in subtables]
+        self.up.curs.execute('SELECT min(id), max(id) FROM redshift.%s' % table)
+        bounds.append(self.up.curs.fetchone())
+        lows = [b[0] for b in bounds if b[0] is not None]
+        highs = [b[1] for b in bounds if b[1] is not None]
+        if not lows:
+            return 0
+        with timed('diff',table):
+            ranges = diffsync.differing_ranges(min(lows),max(highs),source,target,max_rows,fanout)
+        self.up.connection.commit()
+        log('%s id ranges of %s differ, covering up to %s rows' % (len(ranges),table,sum([r[2] for r in ranges])))
+        columns = self.binary_columns(table)
+        for (start_id, end_id, rows) in ranges:
+            self.up.replace_range(table,start_id,end_id,[self.dl.stream(self.dl.model.select_statement_by_ids(subtable,start_id,end_id),columns=columns) for subtable in subtables],binary=columns is not None)
+        return len(ranges)
+
+    def restore_from_snapshots(self,table,start_date=None,end_date=None,date_field='created_at',start_id=None,end_id=None,clear=False):
+        """Load a table class into the upload database from the local snapshots of its subtables instead of from redshift, for instance to rebuild it after an incident or to seed a new database.
+        With clear the table is emptied first, for a full rebuild.  Otherwise only the rows with date_field between start_date and end_date and ids between start_id and end_id (where given) are loaded,
+        replacing those already there for mutable tables.  Each partition is streamed into redshift_staging and merged in the order it was written, so rows from later incremental downloads win.  Return the number of partitions loaded."""
+        if self.dl.snapshots is None:
+            raise ValueError('snapshots are not enabled for this Controller')
+        if clear:
+            self.up.curs.execute('DELETE FROM redshift.%s' % table)
+            self.up.curs.execute('COMMIT;')
+        merge_func = self.merge_function(table)
+        columns = self.binary_columns(table)
+        loaded = 0
+        for subtable in self.dl.model.list_subtables(table):
+            for partition in self.dl.snapshots.partitions(subtable,start_date,end_date,date_field,start_id,end_id):
+                log('restoring %s from snapshot %s' % (table,partition['file']))
+                batches = self.dl.snapshots.read(partition,start_date,end_date,date_field,start_id,end_id)
+                src = rs.CSVStream(batches) if columns is None else pgbinary.BinaryStream(batches,columns)
+                try:
+                    self.up.upload_stream(src,table,merge_func=merge_func,binary=columns is not None)
+                except:
+                    self.up.recover()
+                    raise
+                loaded += 1
+        return loaded
+
+    def watermark_condition(self,table,date_field):
+        """Return a SQL condition selecting the rows of a subtable which an incremental sync needs to download.
+        Uses the table's watermark if it has one for date_field, otherwise falls back to everything from 10 days before the latest date_field value in the upload database.  Return None if the upload database has no rows to go by."""
+        mark = self.watermarks.get(table)
+        if mark is not None and mark[0] == date_field:
+            return self.watermarks.condition(table,overlap=self.watermark_overlap)
+        self.up.curs.execute('SELECT max(%s) FROM %s' % (date_field,self.dl.model.master_table(table)))
+        mrd = self.up.curs.fetchone()[0]
+        if mrd is None:
+            return None
+        dl_start = mrd.date() - timedelta(10)
+        return "trunc(%s) >= '%s'" % (date_field,dl_start.isoformat())
+
+    def transfer_queries(self,table,queries,high_water=None):
+        """For internal usage.  Stream the results of each query into redshift_staging and merge it into the table class, committing after each query.  Abort after the 5th failure.
+        If a HighWater is given it is updated with every row streamed."""
+        merge_func = self.merge_function(table)
+        columns = self.binary_columns(table)
+        failcounter = 0
+        while queries:
+            query = queries.pop(0)
+            try:
+                self.up.upload_stream(self.dl.stream(query,high_water=high_water,columns=columns),table,merge_func=merge_func,binary=columns is not None)
+            except Exception as e:
+                log('encountered an exception of type %s while streaming to %s' % (str(type(e)),table))
+                self.up.recover()
+                queries.append(query)
+                failcounter += 1
+                if failcounter == 5:
+                    log('repeated failures while attempting to stream chunks of %s' % table)
+                    raise e
+                time.sleep(backoff(failcounter))
     
+    def binary_columns(self,table):
+        """Return the model's column tuples for a table if its transfers should use binary COPY, or None if they should use csv."""
+        if not self.binary:
+            return None
+        columns = self.dl.model.list_col_tuples(table)
+        if not pgbinary.supported(columns):
+            log('%s has columns without a binary encoding; streaming it as csv' % table)
+            return None
+        return columns
+
+    def chunk_files(self,subtable,wd=wd):
+        """List the downloaded chunk files of a subtable present in the working directory.  Where a chunk is present both compressed and uncompressed, as after a change of compression setting,
+        only the copy recorded in the manifest is listed."""
+        recorded = Manifest(subtable,wd=wd).recorded()
+        chunks = {}
+        for fname in sorted([f for f in listdir(wd) if f.startswith('%s.cs' % subtable)]):
+            base = strip_suffix(fname)
+            if base not in chunks or fname in recorded:
+                chunks[base] = fname
+        return list(chunks.values())
+
     def upload_chunks(self,subtable,wd=wd):
         log('attempting a chunk upload of table %s' % subtable)
-        local_files = listdir(wd)
-        subtable_files = [f for f in local_files if f.startswith('%s.cs' % subtable)]
+        subtable_files = self.chunk_files(subtable,wd=wd)
         log('located %s files' %str(len(subtable_files)))
-        if self.dl.model.master_table(subtable) in immutables: #identify the correct upload function
-            upload_func = self.up.upload_limited
-        elif self.dl.model.master_table(subtable) in no_date_field:
-            upload_func = self.up.upload_limited_nodate
-        else:  
-            upload_func = self.up.upload_limited_mutable
-        for file in subtable_files:
-            upload_func(file,self.dl.model.master_table(subtable),wd=wd)
-            self.up.curs.execute('COMMIT;')
+        with timed('upload_subtable',subtable):
+            if self.merge_group == 1:
+                for file in subtable_files:
+                    self.upload_chunk(subtable,file,wd=wd)
+            else:
+                for group in self.chunk_groups(subtable_files,wd=wd):
+                    self.upload_group(subtable,group,wd=wd)
             
 
             
@@ -89,12 +451,14 @@ class Controller():
             date_field = 'created_at'
         else:
             date_field = 'updated_at'
-        self.up.curs.execute('SELECT max(%s) FROM %s' % (date_field,master_table))
-        mrd = self.up.curs.fetchone()[0]
-        if mrd is None:
+        condition = self.watermark_condition(table,date_field)
+        if condition is None:
             return
-        dl_start = mrd.date() - timedelta(10)
-        self.dl.download_since_date(table,dl_start,save_as = table + '.csp',date_field=date_field,max_chunk=max_chunk)
+        log('attempting to download %s where %s' % (table,condition))
+        self.dl.maxchunk_download(table,save_as=table + '.csp',max_chunk=max_chunk,date_field=date_field,condition=condition)
+        high = Manifest(table).high_water(table + '.csp')
+        if high is not None:
+            self.watermarks.set_pending(table,date_field,high)
    
     def limited_upload(self,table,fname=None):
         self.up.curs.execute('DELETE FROM redshift_staging.%s;' % table)
@@ -105,10 +469,16 @@ class Controller():
                 fname =  [f for f in local_files if f.startswith('%s.cs' % table)][0]
             except IndexError:
                 return
+        manifest = Manifest(table)
+        verified = manifest.check(fname)
         if table in immutables:
             self.up.upload_limited(fname,table)
         else:
             self.up.upload_limited_mutable(fname,table)
+        if verified:
+            manifest.record_upload(fname)
+            if manifest.all_uploaded():
+                self.watermarks.promote(table)
 
     def alter_for_added_cols(self,table):
         self.dl.model.refresh();
@@ -133,74 +503,194 @@ class Controller():
             
 
 class Downloader():
-    def __init__(self):
-        self.model = rs.Redshift_Data_Model()
-        self.conn = rs.Connection()
+    def __init__(self,fetch_size=rs.default_fetch_size,workers=1,resume=True,compression=None,settings=None,snapshots=False,max_connections=None):
+        """If resume is True, chunked downloads pick up the segment plan of an interrupted earlier download from its manifest and skip chunks already completed.
+        compression may be 'gzip' or 'zstd' to compress files as they are written, in which case the matching suffix is added to their names.
+        settings optionally replaces the redshift connection settings of local_settings.  If snapshots is True every chunk downloaded is also kept as a parquet partition in a SnapshotStore, which needs pyarrow.
+        max_connections is how many redshift connections the pool must allow for: by default one per chunk worker plus the model's and the calling thread's.  Callers running several downloads at once (as Controller.download_all does) must allow for each."""
+        self.settings = settings
+        self.model = rs.Redshift_Data_Model(refresh=False,settings=settings)
+        self.model.db.pool.reserve(max_connections or workers + 2)
+        self.local = threading.local()
+        self.local.conn = self.model.db
+        self.fetch_size = fetch_size
+        self.workers = workers
+        self.resume = resume
+        self.suffix = suffixes[compression] if compression else ''
+        self.snapshots = SnapshotStore() if snapshots else None
+
+    @property
+    def conn(self):
+        """The redshift connection belonging to the calling thread.  The creating thread shares the data model's; worker threads each lease their own from the pool, as a connection can only run one query at a time."""
+        try:
+            return self.local.conn
+        except AttributeError:
+            self.local.conn = rs.Connection(self.settings)
+            return self.local.conn
+
+    def release_conn(self):
+        """Return the calling thread's connection to the pool, if it leased one of its own."""
+        conn = self.local.__dict__.pop('conn',None)
+        if conn is not None and conn is not self.model.db:
+            conn.close()
         
-    def _download(self,query,save_as,save_type='at'):
-        """For internal usage. Downloads and saves the data provided by a specific query."""
+    def _download(self,query,save_as,save_type='at',high_water=None):
+        """For internal usage. Downloads and saves the data provided by a specific query, writing it to disk in batches of self.fetch_size rows as they arrive.
+        Return the number of rows written and, unless appending, the (size, md5) of the file as computed while writing it, for Manifest.record_download.  If a HighWater is given it is updated with every batch written."""
         log('attempting to download %s' % query)
-        data = self.conn.fetch(query)
-        with open(wd + save_as,save_type,newline='\n',encoding='utf-8') as sink:
-            wr = csv.writer(sink)
-            wr.writerows(data)
-            print('wrote %s rows of data to file' % len(data))
-            del data
+        rows = 0
+        write_seconds = 0.0
+        started = time.perf_counter()
+        table_name = save_as.split('.')[0]
+        snapshot = None if self.snapshots is None else self.snapshots.writer(table_name,save_as,self.model.list_col_tuples(table_name))
+        digest = Digest() if 'w' in save_type else None
+        try:
+            with open_chunk(wd + save_as,save_type,digest=digest) as sink:
+                wr = csv.writer(sink)
+                for batch in self.conn.stream(query,fetch_size=self.fetch_size):
+                    write_started = time.perf_counter()
+                    wr.writerows(batch)
+                    if snapshot is not None:
+                        snapshot.write(batch)
+                    write_seconds += time.perf_counter() - write_started
+                    rows += len(batch)
+                    if high_water is not None:
+                        high_water.update(batch)
+        except:
+            if snapshot is not None:
+                snapshot.abort()
+            raise
+        if snapshot is not None:
+            snapshot.commit()
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(wd + save_as)
+        event('fetch',table_name,save_as,seconds=elapsed - write_seconds,rows=rows)
+        event('write',table_name,save_as,seconds=write_seconds,rows=rows,bytes=size)
+        return (rows, digest.summary() if digest is not None else None)
     
-    def download(self,table_name,save_as=None):
+    def download(self,table_name,save_as=None,on_chunk=None):
         """Download a table in one piece.  Intended for use with small tables or tables lacking a created_at field."""
         if not save_as:
             save_as = table_name + '.csv'
         sql = self.model.select_statement(table_name)
-        self._download(sql,save_as,save_type='wt')
+        manifest = Manifest(table_name)
+        self._start(manifest,table_name,save_as,[])
+        (rows, summary) = self._download(sql,save_as + self.suffix,save_type='wt')
+        manifest.record_download(save_as + self.suffix,save_as,rows,summary=summary)
+        self._finish(table_name,save_as)
+        if on_chunk:
+            on_chunk(save_as + self.suffix)
         
-    def maxchunk_download_nodate(self,table_name,save_as=None,max_chunk=200000):
+    def maxchunk_download_nodate(self,table_name,save_as=None,max_chunk=200000,on_chunk=None):
         """download a table in chunks, without referencing a date field."""
         if not save_as:
             save_as = table_name + '.csv'
-        q = "SELECT min(id), max(id) FROM %s" % table_name
-        (min_id, max_id) = self.conn.fetch(q)[0]
-        q = "SELECT count(1) FROM %s" % table_name
-        records = self.conn.fetch(q)[0][0]
-        chunksize = ((max_id - min_id) // records) * max_chunk
-        id_ranges = []
-        while min_id < max_id:
-            id_ranges.append((min_id,min_id+chunksize-1))
-            min_id+= chunksize
+        manifest = Manifest(table_name)
+        params = 'max_chunk=%s' % max_chunk
+        id_ranges = self.resume and manifest.plan(save_as,params)
+        if not id_ranges:
+            id_ranges = self.plan_id_chunks(table_name,max_chunk=max_chunk)
+            self._start(manifest,table_name,save_as,id_ranges,params)
         fnum = 1
         for chunk in id_ranges:
-            self._download(self.model.select_statement_by_ids(table_name,chunk[0],chunk[1]),save_as[:-1] + str(fnum))
+            chunk_fname = self.chunk_name(save_as,fnum)
+            if manifest.downloaded(chunk_fname,save_as):
+                log('skipping %s - already downloaded' % chunk_fname)
+            else:
+                (rows, summary) = self._download(self.model.select_statement_by_ids(table_name,chunk[0],chunk[1]),chunk_fname,save_type='wt')
+                manifest.record_download(chunk_fname,save_as,rows,summary=summary)
+            if on_chunk:
+                on_chunk(chunk_fname)
             fnum += 1
+        self._finish(table_name,save_as)
+
+    def _start(self,manifest,table_name,save_as,segments,params='',full=True):
+        """For internal usage.  Start a fresh download plan in the manifest, and if snapshots are kept and the download is of the whole table, a new snapshot of it."""
+        manifest.start(save_as,segments,params)
+        if self.snapshots is not None and full:
+            self.snapshots.begin(table_name,save_as)
+
+    def _finish(self,table_name,save_as):
+        """For internal usage.  Called once every chunk of a download has been saved, to let a new snapshot supersede the old."""
+        if self.snapshots is not None:
+            self.snapshots.complete(table_name,save_as)
+
+    def plan_id_chunks(self,table_name,max_chunk=200000,condition=None):
+        """Return a list of contiguous (start_id, end_id, rows) ranges splitting a table, or the rows of it meeting the SQL condition provided, into chunks of at most max_chunk rows."""
+        where = ' WHERE %s' % condition if condition else ''
+        (min_id, max_id) = self.conn.fetch("SELECT min(id), max(id) FROM %s%s" % (table_name,where))[0]
+        def histogram(lo,hi,width):
+            q = "SELECT %s + ((id - %s) / %s) * %s AS bucket, count(1) FROM %s WHERE id BETWEEN %s AND %s" % (lo,lo,width,width,table_name,lo,hi)
+            if condition:
+                q += ' AND %s' % condition
+            return self.conn.fetch(q + ' GROUP BY 1 ORDER BY 1')
+        return planner.plan_ids(min_id,max_id,max_chunk,histogram)
     
     def download_since_date(self,table_name,start_date,save_as=None,date_field='created_at',max_chunk=200000):
         """Download records in a table with a created_at field greater than or equal to the value provided."""
         log('attempting to download %s since %s' % (table_name, start_date.isoformat()))
 
-        where_clause = " WHERE trunc(%s) >= '%s'" % (date_field,start_date.isoformat())
-        self.maxchunk_download(table_name,save_as=save_as,max_chunk=max_chunk,where_clause=where_clause,date_field=date_field)
+        condition = "trunc(%s) >= '%s'" % (date_field,start_date.isoformat())
+        self.maxchunk_download(table_name,save_as=save_as,max_chunk=max_chunk,date_field=date_field,condition=condition)
         
     
-    def _download_chunks(self,table_name,save_as,segments,date_field='created_at'):
-        """For internal usage.  Generates queries and calls _download for a series of chunks defined by a start and an end (in python date format) range of created_at values"""
-        completed_segments = []
-        failcounter = 0
-        while True:
-            try:
-                curr_segment = segments.pop(0)
-            except IndexError:
-                break
-            try:
-                save_type = 'wt'
-                chunk_fname = save_as[:-1] + str(curr_segment[2])
-                self._download(self.model.select_statement_by_dates(table_name,curr_segment[0],curr_segment[1],date_field=date_field),chunk_fname,save_type=save_type)
-                completed_segments.append(curr_segment)
-            except Exception as e:
-                log('encountered an exception of type %s' % str(type(e)))
-                segments.append(curr_segment)
-                failcounter +=1 
-                if failcounter == 5:
-                    log('repeated failures while attempting to download chunks of %s' %table_name)
-                    raise e
+    def _download_chunks(self,table_name,save_as,segments,date_field='created_at',on_chunk=None,manifest=None,condition=None):
+        """For internal usage.  Generates queries and calls _download for a series of chunks defined by a start and an end (in python date format) range of created_at values.
+        Up to self.workers chunks are downloaded at once.  Failed chunks are retried after a growing delay, on a fresh connection if theirs was lost, and the download is abandoned once any single chunk has failed 5 times.
+        on_chunk, if given, is called with the file name of each chunk once it and every chunk before it have been completely written, so chunks are passed on in order however many workers there are.
+        Chunks recorded in the manifest as already downloaded are skipped; if no manifest is given a fresh one is started."""
+        if manifest is None:
+            manifest = Manifest(table_name)
+            self._start(manifest,table_name,save_as,segments,full=not condition)
+        failcounters = {}
+        unreleased = sorted([segment[2] for segment in segments])
+        finished = set()
+        def release(num):
+            finished.add(num)
+            while on_chunk and unreleased and unreleased[0] in finished:
+                on_chunk(self.chunk_name(save_as,unreleased.pop(0)))
+        for segment in list(segments):
+            chunk_fname = self.chunk_name(save_as,segment[2])
+            if manifest.downloaded(chunk_fname,save_as):
+                log('skipping %s - already downloaded' % chunk_fname)
+                segments.remove(segment)
+                release(segment[2])
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self._download_segment,table_name,save_as,segment,date_field,manifest,condition): segment for segment in segments}
+            while pending:
+                done, _ = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    curr_segment = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        log('encountered an exception of type %s' % str(type(e)))
+                        failcounters[curr_segment[2]] = failcounters.get(curr_segment[2],0) + 1
+                        if failcounters[curr_segment[2]] == 5:
+                            log('repeated failures while attempting to download chunks of %s' %table_name)
+                            for f in pending:
+                                f.cancel()
+                            raise e
+                        pending[pool.submit(self._download_segment,table_name,save_as,curr_segment,date_field,manifest,condition,backoff(failcounters[curr_segment[2]]))] = curr_segment
+                        continue
+                    release(curr_segment[2])
+        self._finish(table_name,save_as)
+
+    def chunk_name(self,save_as,num):
+        """Return the file name of the numbered chunk of a download saved as save_as."""
+        return save_as[:-1] + str(num) + self.suffix
+
+    def _download_segment(self,table_name,save_as,segment,date_field,manifest,condition=None,delay=0):
+        """For internal usage.  Download a single (start_date, end_date, chunk_number) segment to its own chunk file and record it, and the greatest (date_field, id) it contains, in the manifest.
+        Waits delay seconds first, for retries to back off.  The worker's connection goes back to the pool afterwards."""
+        time.sleep(delay)
+        try:
+            chunk_fname = self.chunk_name(save_as,segment[2])
+            high_water = self.high_water(table_name,date_field)
+            (rows, summary) = self._download(self.segment_query(table_name,segment,date_field,condition),chunk_fname,save_type='wt',high_water=high_water)
+            manifest.record_download(chunk_fname,save_as,rows,high_water.mark if high_water is not None else None,summary=summary)
+        finally:
+            self.release_conn()
                    
    
     def piecewise_download(self,table_name,save_as = None,chunks=10):
@@ -229,30 +719,82 @@ class Downloader():
         self._download_chunks(table_name,save_as,segments)
 
           
-    def maxchunk_download(self,table_name,save_as = None,max_chunk=5000000,where_clause='',date_field='created_at'):
-        """Download a large table in chunks with a target maximum size (in practice each chunk will be slightly larger than that size, but should be close enough for most purposes."""
+    def maxchunk_download(self,table_name,save_as = None,max_chunk=5000000,where_clause='',date_field='created_at',on_chunk=None,condition=None,segments=None):
+        """Download a large table in chunks of at most max_chunk rows (as counted when the chunks are planned).  If a SQL condition is provided, only rows meeting it are downloaded.
+        segments, if given, is a fresh plan made by plan_chunks with the same arguments, which is downloaded instead of planning again or resuming an earlier download."""
         log('attempting chunk download of %s with max chunk size %s rows' % (table_name,str(max_chunk)))
         if not save_as:
             save_as = table_name + '.csv'
+        if condition:
+            where_clause = ' WHERE ' + condition
+        manifest = Manifest(table_name)
+        params = 'max_chunk=%s where_clause=%s date_field=%s' % (max_chunk,where_clause,date_field)
+        if segments is not None:
+            self._start(manifest,table_name,save_as,segments,params,full=not where_clause)
+            self._download_chunks(table_name,save_as,segments,date_field=date_field,on_chunk=on_chunk,manifest=manifest,condition=condition)
+            return
+        segments = self.resume and manifest.plan(save_as,params)
+        if segments:
+            log('resuming the interrupted download of %s' % save_as)
+            segments = [planner.Segment(date.fromisoformat(s[0]),date.fromisoformat(s[1]),*s[2:]) for s in segments]
+        else:
+            segments = self.plan_chunks(table_name,max_chunk=max_chunk,where_clause=where_clause,date_field=date_field,condition=condition)
+            self._start(manifest,table_name,save_as,segments,params,full=not where_clause)
+        self._download_chunks(table_name,save_as,segments,date_field=date_field,on_chunk=on_chunk,manifest=manifest,condition=condition)
+
+    def plan_chunks(self,table_name,max_chunk=5000000,where_clause='',date_field='created_at',condition=None):
+        """Return a list of planner.Segments splitting a table into chunks of at most max_chunk rows.  Days are grouped together where they fit, and days too large for a single chunk are split by id.
+        Only rows meeting the SQL condition, if one is provided, are considered."""
+        if condition:
+            where_clause = ' WHERE %s' % condition
         q = "SELECT trunc(%s) create_date, count(1) FROM %s %s GROUP BY trunc(%s) ORDER BY trunc(%s)" % (date_field,table_name,where_clause,date_field,date_field)
         dates = self.conn.fetch(q)
-        segments = []
-        #identify start and end dates for the created_at field to split the table into the specified number of approximately equal-sized chunks
-        chunk = 1
-        while True:
-            tot = 0
-            try:
-                start = dates[0][0]
-            except IndexError:
-                break
-            while tot < max_chunk:
-                try:
-                    curr_date = dates.pop(0)
-                    tot += curr_date[1]
-                except IndexError:
-                    break
-            end = curr_date[0]
-            segments.append((start, end, chunk))
-            chunk += 1
-            print('expecting %s between %s and %s' % (str(tot), start.isoformat(), end.isoformat()))
-        self._download_chunks(table_name,save_as,segments,date_field=date_field)
\ No newline at end of file
+        split_day = None
+        if 'id' in self.model.list_cols(table_name):
+            def split_day(day):
+                day_condition = "trunc(%s) = '%s'" % (date_field,day.isoformat())
+                return self.plan_id_chunks(table_name,max_chunk=max_chunk,condition=day_condition + (' AND %s' % condition if condition else ''))
+        segments = planner.plan_dates(dates,max_chunk,split_day)
+        for segment in segments:
+            log('expecting %s rows of %s between %s and %s' % (segment.rows,table_name,segment.start.isoformat(),segment.end.isoformat()))
+        return segments
+
+    def segment_query(self,table_name,segment,date_field='created_at',condition=None):
+        """Return the select statement for a single segment, including its id range if it has one."""
+        if len(segment) > 3 and segment[3] is not None:
+            id_condition = 'id BETWEEN %s AND %s' % (segment[3],segment[4])
+            condition = id_condition + (' AND %s' % condition if condition else '')
+        return self.model.select_statement_by_dates(table_name,segment[0],segment[1],date_field=date_field,condition=condition)
+
+    def chunk_queries(self,table_name,max_chunk=5000000,where_clause='',date_field='created_at',condition=None):
+        """Return the select statements that the chunked downloads would run for a table, for callers that stream results rather than saving them.  Tables without a usable date field are split by id."""
+        if self.model.master_table(table_name) in no_date_field or self.model.master_table(table_name) == 'donations_recurring_donations':
+            return [self.model.select_statement_by_ids(table_name,r[0],r[1]) for r in self.plan_id_chunks(table_name,max_chunk=max_chunk)]
+        if date_field not in self.model.list_cols(table_name):
+            return [self.model.select_statement(table_name)]
+        segments = self.plan_chunks(table_name,max_chunk=max_chunk,where_clause=where_clause,date_field=date_field,condition=condition)
+        return [self.segment_query(table_name,s,date_field,condition) for s in segments]
+
+    def stream(self,query,high_water=None,columns=None):
+        """Return a file-like object yielding the results of a query as csv text, suitable for passing straight to Uploader.upload_stream.  If a HighWater is given it is updated with every batch streamed.
+        If the query's column tuples are given the results are encoded in the binary COPY format instead, for upload_stream with binary=True."""
+        log('attempting to stream %s' % query)
+        batches = self.conn.stream(query,fetch_size=self.fetch_size)
+        if high_water is not None:
+            batches = tracked(batches,high_water)
+        if columns is not None:
+            return pgbinary.BinaryStream(batches,columns)
+        return rs.CSVStream(batches)
+
+    def high_water(self,table_name,date_field):
+        """Return a HighWater tracking the greatest (date_field, id) of the rows downloaded from a table, or None if the table lacks either column."""
+        cols = self.model.list_cols(table_name)
+        if date_field not in cols or 'id' not in cols:
+            return None
+        return HighWater(cols.index(date_field),cols.index('id'))
+
+def tracked(batches,high_water):
+    """Pass batches of rows through unchanged, updating a HighWater with each."""
+    for batch in batches:
+        high_water.update(batch)
+        yield batch
@@ -1,25 +1,96 @@
-from .upbound import Uploader
+from .upbound import Uploader, csv_format
+from .redshift import CSVStream
+from .log import log, timed
 import csv
-from io import StringIO
+import os
+import re
+import time
+from datetime import datetime
 
-up = Uploader()
+#connected on first use, so importing this module does not open a connection to the upload database
+up = None
 
-def csv_to_table(fname,dest):
-    with open(fname,'rt',encoding='latin1') as src:
-        r = csv.reader(src)
-        header = next(r)
-        data_types = next(r)
-        data = [row for row in r]
-    up.curs.execute('DROP TABLE IF EXISTS api_client.%s' % dest)
-    stmnt = 'CREATE TABLE api_client.%s (' % (dest,) + ','.join(['%s %s' % (header[i], data_types[i]) for i in range(len(header))]) + ');'
-    up.curs.execute(stmnt)
+#rows per batch rendered and sent to COPY, and how often progress is logged
+batch_size = 10000
+progress_every = 500000
 
-    dummy = StringIO('\n'.join([','.join([f for f in row]) for row in data]))
+def uploader():
+    global up
+    if up is None:
+        up = Uploader()
+    return up
 
-    up.curs.copy_expert("COPY api_client.%s FROM STDIN csv encoding 'latin1'" % dest,dummy)
-    up.curs.execute('GRANT ALL PRIVILEGES ON TABLE api_client.%s TO cc_users' % dest)
-    up.curs.execute('COMMIT;')
+def infer_type(values):
+    """Return the narrowest postgres type accepting every non-empty value in a sample of a column, falling back to text.
+    Digit strings with leading zeros, such as zip codes and phone numbers, are kept as text so the zeros are not lost."""
+    values = [v for v in values if v != '']
+    if not values or any([re.match(r'^-?0\d',v) for v in values]):
+        return 'text'
+    def all_parse(parse):
+        try:
+            for v in values:
+                parse(v)
+        except ValueError:
+            return False
+        return True
+    if all([re.match(r'^-?\d+$',v) for v in values]):
+        return 'integer' if all([-2**31 <= int(v) < 2**31 for v in values]) else 'bigint'
+    if all([re.match(r'^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$',v) for v in values]):
+        return 'numeric'
+    if all([v.lower() in ('true','false','t','f') for v in values]):
+        return 'boolean'
+    if all_parse(lambda v: datetime.strptime(v,'%Y-%m-%d')):
+        return 'date'
+    if all_parse(lambda v: datetime.fromisoformat(v)):
+        return 'timestamp'
+    return 'text'
 
+def infer_types(header,sample):
+    return [infer_type([row[i] for row in sample if i < len(row)]) for i in range(len(header))]
 
+def batched(rows,first=(),size=batch_size,dest=None):
+    """Yield lists of up to size rows, those in first followed by the rest of the rows iterator, logging progress and throughput along the way."""
+    started = time.perf_counter()
+    count = 0
+    batch = list(first)
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            count += len(batch)
+            if count // progress_every != (count - len(batch)) // progress_every:
+                log('imported %s rows to %s, %.0f rows/sec' % (count,dest,count / (time.perf_counter() - started)))
+            batch = []
+    if batch:
+        yield batch
 
- 
+def csv_to_table(fname,dest,encoding='latin1',types_row=True,sample_size=1000):
+    """Create api_client.dest from a csv file and load it, streaming the file in batches so memory use does not grow with its size.
+    The first row of the file must give the column names, and the second their postgres types.  For files without a row of types, pass types_row=False to have the types
+    inferred from the first sample_size rows instead, which then must be representative of the whole file."""
+    up = uploader()
+    with open(fname,'rt',encoding=encoding,newline='') as src:
+        r = csv.reader(src)
+        header = next(r)
+        if types_row:
+            data_types = next(r)
+            first = []
+        else:
+            first = [row for (i, row) in zip(range(sample_size),r)]
+            data_types = infer_types(header,first)
+            log('inferred types of %s: %s' % (fname,', '.join(data_types)))
+        up.curs.execute('DROP TABLE IF EXISTS api_client.%s' % dest)
+        stmnt = 'CREATE TABLE api_client.%s (' % (dest,) + ','.join(['%s %s' % (header[i], data_types[i]) for i in range(len(header))]) + ');'
+        up.curs.execute(stmnt)
+        try:
+            with timed('import',dest,fname) as stats:
+                stream = CSVStream(batched(r,first,dest=dest))
+                up.curs.copy_expert("COPY api_client.%s FROM STDIN %s" % (dest,csv_format),stream)
+                stats['rows'] = stream.rows
+                stats['bytes'] = os.path.getsize(fname)
+            up.curs.execute('GRANT ALL PRIVILEGES ON TABLE api_client.%s TO cc_users' % dest)
+            up.curs.execute('COMMIT;')
+        except:
+            up.connection.rollback()
+            raise
+    log('imported %s rows from %s to api_client.%s' % (stream.rows,fname,dest))
@@ -0,0 +1,73 @@
+#range-checksum comparison of a table between redshift and the upload database, used to find the id ranges which need re-syncing
+
+#the first 32 bits of an md5 hex digest as a bigint, in each dialect: redshift has strtol, postgres a cast through bit(32)
+hash_expressions = {
+    'redshift':"strtol(substring(md5(%s),1,8),16)",
+    'postgres':"cast(cast('x' || substring(md5(%s),1,8) as bit(32)) as bigint)",
+}
+
+#the text type values are cast to for hashing in each dialect: a plain varchar is only 256 bytes on redshift, which would cut long values short
+text_types = {
+    'redshift':'varchar(65535)',
+    'postgres':'text',
+}
+
+def row_text(columns,dialect='redshift'):
+    """Return an expression rendering a row as text, for hashing, from (column expression, data_type) pairs.  Nulls and empty strings render alike, as the csv loads turn one into the other.
+    Booleans are spelled out, as redshift cannot cast them to text."""
+    parts = []
+    for (name, data_type) in columns:
+        if data_type == 'boolean':
+            parts.append("CASE WHEN %s THEN 't' WHEN NOT %s THEN 'f' ELSE '' END" % (name,name))
+        else:
+            parts.append("coalesce(cast(%s as %s),'')" % (name,text_types[dialect]))
+    return " || '|' || ".join(parts)
+
+def fingerprint_query(table,lo,hi,width,date_field='updated_at',columns=None,dialect='redshift'):
+    """Return a query giving, for each non-empty bucket of the given width of ids from lo to hi, the bucket start followed by a fingerprint of its rows:
+    row count, latest date_field, sum of ids, sum of date_field epochs, a sum mixing each row's id with its date_field so rows swapping values are noticed,
+    and, if the table's (column expression, data_type) pairs are given, a sum of hashes of each row's values, so changes made without touching date_field are noticed too.
+    dialect ('redshift' or 'postgres') selects how the hashes are computed; they agree between the two as long as both render the values as the same text.  That may not hold for floating point columns,
+    nor for timestamp with time zone columns unless both sessions use the same TimeZone setting, and ranges holding such differences are replaced on every run."""
+    epoch = 'cast(extract(epoch from %s) as bigint)' % date_field
+    checksum = ', sum(%s)' % (hash_expressions[dialect] % row_text(columns,dialect)) if columns else ''
+    return ("SELECT %s + ((id - %s) / %s) * %s AS bucket, count(1), max(%s), sum(cast(id as bigint)), sum(%s), sum((%s %% 1000003) * (id %% 1009))%s FROM %s WHERE id BETWEEN %s AND %s GROUP BY 1 ORDER BY 1"
+            % (lo,lo,width,width,date_field,epoch,epoch,checksum,table,lo,hi))
+
+def combine(fingerprints):
+    """Combine lists of (bucket, count, latest, sums...) rows, for instance from several subtables, into a dict of bucket -> combined fingerprint."""
+    combined = {}
+    for rows in fingerprints:
+        for (bucket, count, latest, *sums) in rows:
+            if bucket not in combined:
+                combined[bucket] = (count, latest) + tuple(sums)
+                continue
+            c = combined[bucket]
+            latest = c[1] if latest is None or (c[1] is not None and c[1] > latest) else latest
+            combined[bucket] = (c[0] + count, latest) + tuple([(a or 0) + (b or 0) for (a, b) in zip(c[2:],sums)])
+    return combined
+
+def differing_ranges(lo,hi,source,target,max_rows,fanout=16):
+    """Return the ordered (start_id, end_id, rows) ranges between lo and hi where the fingerprints of source and target differ, narrowed down until each holds at most max_rows rows on either side.
+    source(lo, hi, width) and target(lo, hi, width) must return dicts of bucket start -> fingerprint as made by combine.  Adjacent differing ranges are merged where the result still fits in max_rows."""
+    if lo is None or hi is None:
+        return []
+    width = max(1, -(-(hi - lo + 1) // fanout))
+    src = source(lo,hi,width)
+    tgt = target(lo,hi,width)
+    ranges = []
+    for bucket in sorted(set(src) | set(tgt)):
+        if src.get(bucket) == tgt.get(bucket):
+            continue
+        end = min(bucket + width - 1, hi)
+        rows = max(src.get(bucket,(0,))[0], tgt.get(bucket,(0,))[0])
+        if rows <= max_rows or width == 1:
+            found = [(bucket, end, rows)]
+        else:
+            found = differing_ranges(bucket,end,source,target,max_rows,fanout)
+        for r in found:
+            if ranges and ranges[-1][1] + 1 == r[0] and ranges[-1][2] + r[2] <= max_rows:
+                ranges[-1] = (ranges[-1][0], r[1], ranges[-1][2] + r[2])
+            else:
+                ranges.append(r)
+    return ranges
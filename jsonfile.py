@@ -0,0 +1,29 @@
+import json
+import os
+import threading
+
+#one lock per file, shared by every JSONFile for the same path, so threads updating a file never lose each other's changes
+locks = {}
+locks_lock = threading.Lock()
+
+class JSONFile():
+    """A json document kept in a single file, such as a manifest or the watermarks, which is read and rewritten whole for every change.
+    Writes go to a temporary file which then replaces the original in one step, so readers never see a partial file.  Hold lock around a read and the write which follows it."""
+    def __init__(self,path,default=dict):
+        """default is called to make the document's value when the file does not exist yet."""
+        self.path = path
+        self.default = default
+        with locks_lock:
+            self.lock = locks.setdefault(path,threading.Lock())
+
+    def read(self):
+        try:
+            with open(self.path,'rt') as src:
+                return json.load(src)
+        except FileNotFoundError:
+            return self.default()
+
+    def write(self,data):
+        with open(self.path + '.tmp','wt') as sink:
+            json.dump(data,sink,default=str)
+        os.replace(self.path + '.tmp',self.path)
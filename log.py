@@ -1,4 +1,84 @@
 from datetime import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+#where structured performance events go: a json lines file receiving every event, and a prometheus textfile collector file of per-table, per-stage totals.  Set with configure; None disables either.
+events_file = None
+prometheus_file = None
+
+lock = threading.Lock()
+#stages recorded for individual chunks, which between them account for the time spent on a table without overlapping
+chunk_stages = ['fetch','write','copy','merge','transfer']
+#running totals for this run, keyed by (table, stage), each a dict of seconds, rows, bytes and events
+totals = {}
 
 def log(msg):
-    print(datetime.now().isoformat() + ' - ' + msg)
\ No newline at end of file
+    print(datetime.now().isoformat() + ' - ' + msg)
+
+def configure(events=None,prometheus=None):
+    """Set the json lines file which receives every performance event, and the prometheus textfile which receives the totals when write_prometheus is called."""
+    global events_file, prometheus_file
+    events_file = events
+    prometheus_file = prometheus
+
+def event(stage,table=None,chunk=None,seconds=0.0,rows=None,bytes=None,**fields):
+    """Record a structured performance event for one stage of work on a table (and optionally a single chunk of it), adding it to the totals for this run and to the events file if one is configured."""
+    record = {'time':datetime.now().isoformat(),'stage':stage,'table':table,'chunk':chunk,'seconds':round(seconds,4),'rows':rows,'bytes':bytes,
+              'rows_per_sec':round(rows / seconds,1) if rows and seconds else None}
+    record.update(fields)
+    with lock:
+        total = totals.setdefault((table,stage),{'seconds':0.0,'rows':0,'bytes':0,'events':0})
+        total['seconds'] += seconds
+        total['rows'] += rows or 0
+        total['bytes'] += bytes or 0
+        total['events'] += 1
+        if events_file:
+            with open(events_file,'at') as sink:
+                sink.write(json.dumps(record,default=str) + '\n')
+
+@contextmanager
+def timed(stage,table=None,chunk=None,**fields):
+    """Time the enclosed block and record it as an event.  The block may fill in 'rows' and 'bytes' in the dict it is given.  Nothing is recorded if the block raises."""
+    stats = {}
+    started = time.perf_counter()
+    yield stats
+    fields.update(stats)
+    event(stage,table,chunk,seconds=time.perf_counter() - started,**fields)
+
+def total(tables,stage,key='rows'):
+    """Return the sum of one of the totals (seconds, rows, bytes or events) of a stage over the given tables so far this run."""
+    with lock:
+        return sum([totals.get((table,stage),{}).get(key,0) for table in tables])
+
+def summary(top=10):
+    """Log the slowest tables (by time spent on their chunks) and the slowest table stages of this run, with their throughput."""
+    with lock:
+        items = list(totals.items())
+    by_table = {}
+    for ((table, stage), total) in items:
+        if table is not None and stage in chunk_stages:
+            by_table[table] = by_table.get(table,0.0) + total['seconds']
+    log('slowest tables: ' + ', '.join(['%s %.1fs' % t for t in sorted(by_table.items(),key=lambda t: -t[1])[:top]]))
+    for ((table, stage), total) in sorted(items,key=lambda i: -i[1]['seconds'])[:top]:
+        rate = total['rows'] / total['seconds'] if total['seconds'] else 0
+        log('%s %s: %.1fs, %s rows, %s bytes, %.0f rows/sec over %s events' % (table,stage,total['seconds'],total['rows'],total['bytes'],rate,total['events']))
+
+def write_prometheus(path=None):
+    """Write the totals of this run to a prometheus textfile collector file, by default the one set with configure."""
+    path = path or prometheus_file
+    if not path:
+        return
+    lines = []
+    with lock:
+        items = sorted(totals.items(),key=lambda i: (str(i[0][0]),i[0][1]))
+    for (metric, key, description) in [('mirror_stage_seconds','seconds','Seconds spent in each stage of the mirror sync'),('mirror_stage_rows','rows','Rows handled by each stage of the mirror sync'),('mirror_stage_bytes','bytes','Bytes handled by each stage of the mirror sync')]:
+        lines.append('# HELP %s %s' % (metric,description))
+        lines.append('# TYPE %s gauge' % metric)
+        for ((table, stage), total) in items:
+            lines.append('%s{table="%s",stage="%s"} %s' % (metric,table or '',stage,total[key]))
+    with open(path + '.tmp','wt') as sink:
+        sink.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp',path)
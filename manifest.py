@@ -0,0 +1,148 @@
+import os
+import hashlib
+from datetime import datetime
+from .local_settings import working_directory as wd
+from .chunkfile import strip_suffix
+from .jsonfile import JSONFile
+
+class Manifest():
+    """Record of the chunked downloads of a single (sub)table, saved as json in the working directory alongside the chunk files.
+    For each download it holds the segment plan, and for each chunk file the download it belongs to, its row count, byte size, md5 checksum and whether it has been downloaded and uploaded,
+    so that an interrupted run can be resumed and truncated files can be detected before loading.
+    Full (.csv) and incremental (.csp) downloads of a table write chunks of the same names, so chunks are matched to a download by the save_as recorded with them rather than by name."""
+
+    def __init__(self,table_name,wd=wd):
+        self.table_name = table_name
+        self.wd = wd
+        self.path = wd + table_name + '.manifest.json'
+        self.data_file = JSONFile(self.path,default=lambda: {'plans':{},'chunks':{}})
+
+    def plan(self,save_as,params=''):
+        """Return the stored segment plan for downloads saved as save_as if it was interrupted and can be resumed, otherwise None: if there is no plan, it was made with different planning parameters,
+        or every file of it was downloaded and is still on disk at its recorded size, in which case the next download should start afresh rather than reuse stale files."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+        try:
+            plan = data['plans'][save_as]
+        except KeyError:
+            return None
+        if plan['params'] != params:
+            return None
+        if self.complete(save_as) and all([self.verify(f,checksum=False) for f in self.files(save_as)]):
+            return None
+        return plan['segments']
+
+    def start(self,save_as,segments,params=''):
+        """Record a new segment plan, and the parameters it was made with, for downloads saved as save_as, forgetting any chunks recorded under a previous plan."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+            data['plans'][save_as] = {'params':params,'segments':segments}
+            data['chunks'] = dict([(f,c) for f,c in data['chunks'].items() if c.get('save_as') != save_as])
+            self.data_file.write(data)
+
+    def record_download(self,fname,save_as,rows,high=None,summary=None):
+        """Record that a chunk file of the download saved as save_as has been completely written, along with its row count, size and checksum, and optionally the greatest (timestamp, id) key it contains.
+        summary is the (size, md5) of the file if the caller computed them while writing it; otherwise the file is read to compute them."""
+        (size, checksum) = summary or file_summary(self.wd + fname)
+        if high is not None:
+            high = [high[0].isoformat(),high[1]]
+        with self.data_file.lock:
+            data = self.data_file.read()
+            data['chunks'][fname] = {'save_as':save_as,'rows':rows,'bytes':size,'md5':checksum,'status':'downloaded','high':high}
+            self.data_file.write(data)
+
+    def recorded(self):
+        """Return the names of all the files recorded in the manifest."""
+        with self.data_file.lock:
+            return set(self.data_file.read()['chunks'])
+
+    def files(self,save_as):
+        """Return the files recorded under the current plan of downloads saved as save_as: its numbered chunks, or the single file of a table downloaded in one piece."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+        return sorted([f for f,c in data['chunks'].items() if c.get('save_as') == save_as])
+
+    def complete(self,save_as):
+        """Return True if every segment of the stored plan for downloads saved as save_as has its own file recorded as downloaded by that plan: its chunk, numbered from 1, or the single file of a table downloaded in one piece."""
+        with self.data_file.lock:
+            plan = self.data_file.read()['plans'].get(save_as)
+        if plan is None:
+            return False
+        expected = [save_as[:-1] + str(num) for num in range(1,len(plan['segments']) + 1)] or [save_as]
+        return set(expected) <= set([strip_suffix(f) for f in self.files(save_as)])
+
+    def record_upload(self,fname):
+        with self.data_file.lock:
+            data = self.data_file.read()
+            data['chunks'][fname]['status'] = 'uploaded'
+            self.data_file.write(data)
+
+    def reset_uploads(self):
+        """Mark every chunk as not yet uploaded, ahead of reloading the table from scratch."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+            for c in data['chunks'].values():
+                c['status'] = 'downloaded'
+            self.data_file.write(data)
+
+    def downloaded(self,fname,save_as):
+        """Return True if a chunk file has been completely downloaded, by the download saved as save_as, and is unchanged since."""
+        with self.data_file.lock:
+            chunk = self.data_file.read()['chunks'].get(fname)
+        return chunk is not None and chunk.get('save_as') == save_as and self.verify(fname)
+
+    def uploaded(self,fname):
+        with self.data_file.lock:
+            chunk = self.data_file.read()['chunks'].get(fname)
+        return chunk is not None and chunk['status'] == 'uploaded'
+
+    def all_uploaded(self):
+        with self.data_file.lock:
+            statuses = [c['status'] for c in self.data_file.read()['chunks'].values()]
+        return 'downloaded' not in statuses
+
+    def high_water(self,save_as):
+        """Return the greatest (timestamp, id) key recorded among the chunks of a download, or None if none was recorded."""
+        with self.data_file.lock:
+            highs = [c.get('high') for c in self.data_file.read()['chunks'].values() if c.get('save_as') == save_as]
+        highs = [(datetime.fromisoformat(h[0]),h[1]) for h in highs if h]
+        if not highs:
+            return None
+        return max(highs)
+
+    def partially_uploaded(self):
+        """Return True if some, but not all, of the recorded chunks have been uploaded."""
+        with self.data_file.lock:
+            statuses = [c['status'] for c in self.data_file.read()['chunks'].values()]
+        return 'uploaded' in statuses and 'downloaded' in statuses
+
+    def verify(self,fname,checksum=True):
+        """Return False if a chunk file is missing or its size or checksum differ from those recorded when it was downloaded, True if they match, and None if the file is not in the manifest.
+        With checksum False only the size is compared, which avoids reading the file."""
+        with self.data_file.lock:
+            chunk = self.data_file.read()['chunks'].get(fname)
+        if chunk is None:
+            return None
+        try:
+            if not checksum:
+                return os.path.getsize(self.wd + fname) == chunk['bytes']
+            return file_summary(self.wd + fname) == (chunk['bytes'],chunk['md5'])
+        except FileNotFoundError:
+            return False
+
+    def check(self,fname,required=False):
+        """Return verify(fname), raising IOError if the file does not match the manifest, or with required, if it is not in the manifest at all."""
+        verified = self.verify(fname)
+        if verified is False:
+            raise IOError('%s does not match its manifest - refusing to load a truncated or altered file' % fname)
+        if verified is None and required:
+            raise IOError('%s is not in its manifest - refusing to load a file which cannot be checked' % fname)
+        return verified
+
+def file_summary(path):
+    """Return the size in bytes and md5 hex digest of a file."""
+    md5 = hashlib.md5()
+    with open(path,'rb') as src:
+        for block in iter(lambda: src.read(1 << 20),b''):
+            md5.update(block)
+    return (os.path.getsize(path), md5.hexdigest())
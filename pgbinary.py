@@ -0,0 +1,251 @@
+import csv
+import struct
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from io import StringIO
+
+#postgres binary COPY encoding of fetched rows, as an alternative to rendering and re-parsing csv
+
+header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii',0,0)
+trailer = struct.pack('!h',-1)
+null = struct.pack('!i',-1)
+
+pg_epoch_date = date(2000,1,1)
+pg_epoch = datetime(2000,1,1)
+pg_epoch_tz = datetime(2000,1,1,tzinfo=timezone.utc)
+
+def packer(fmt):
+    size = struct.calcsize(fmt)
+    prefix = struct.pack('!i',size)
+    pack = struct.Struct('!' + fmt).pack
+    return lambda value: prefix + pack(value)
+
+def encode_text(value):
+    #the csv path writes empty strings unquoted, which COPY reads as null, so do the same to give identical results
+    if value == '':
+        return null
+    data = str(value).encode('utf-8')
+    return struct.pack('!i',len(data)) + data
+
+def encode_bool(value):
+    return b'\x00\x00\x00\x01' + (b'\x01' if value else b'\x00')
+
+def encode_date(value):
+    return struct.pack('!ii',4,(value - pg_epoch_date).days)
+
+def encode_timestamp(value):
+    delta = value - pg_epoch
+    return struct.pack('!iq',8,(delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+def encode_timestamptz(value):
+    delta = value - pg_epoch_tz
+    return struct.pack('!iq',8,(delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+def encode_numeric(value):
+    """Encode a number in postgres' binary numeric format: base 10000 digits preceded by their count, the weight of the first, the sign and the display scale."""
+    value = Decimal(value)
+    if value.is_nan():
+        data = struct.pack('!hhHh',0,0,0xC000,0)
+        return struct.pack('!i',len(data)) + data
+    (sign, digits, exponent) = value.as_tuple()
+    dscale = max(0,-exponent)
+    digits = ''.join(map(str,digits))
+    if exponent > 0:
+        digits += '0' * exponent
+        exponent = 0
+    if -exponent > len(digits):
+        digits = '0' * (-exponent - len(digits)) + digits
+    integer = digits[:len(digits) + exponent]
+    fraction = digits[len(digits) + exponent:]
+    integer = '0' * (-len(integer) % 4) + integer
+    fraction = fraction + '0' * (-len(fraction) % 4)
+    groups = [int(integer[i:i+4]) for i in range(0,len(integer),4)] + [int(fraction[i:i+4]) for i in range(0,len(fraction),4)]
+    weight = len(integer) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    data = struct.pack('!hhHh',len(groups),weight,0x4000 if sign else 0,dscale) + struct.pack('!%dH' % len(groups),*groups)
+    return struct.pack('!i',len(data)) + data
+
+#encoders by information_schema data_type
+encoders = {
+    'smallint':packer('h'),
+    'integer':packer('i'),
+    'bigint':packer('q'),
+    'real':packer('f'),
+    'double precision':packer('d'),
+    'boolean':encode_bool,
+    'character varying':encode_text,
+    'character':encode_text,
+    'text':encode_text,
+    'date':encode_date,
+    'timestamp without time zone':encode_timestamp,
+    'timestamp with time zone':encode_timestamptz,
+    'numeric':encode_numeric,
+}
+
+def supported(columns):
+    """Return whether every one of the given model column tuples has a binary encoding."""
+    return all([col[1] in encoders for col in columns])
+
+class BinaryEncoder():
+    """Encodes rows into postgres' binary COPY format, using the column tuples (col_name, data_type, char_len, num_precision, num_radix) of the data model.
+    The destination table must have exactly those types, as tables created from Redshift_Data_Model.create_statement do.  Raises TypeError for columns of a type it cannot encode."""
+    def __init__(self,columns):
+        try:
+            self.encoders = [encoders[col[1]] for col in columns]
+        except KeyError as e:
+            raise TypeError('no binary COPY encoding for columns of type %s' % e.args[0])
+        self.count = struct.pack('!h',len(columns))
+
+    def encode(self,batch):
+        parts = []
+        for row in batch:
+            parts.append(self.count)
+            for (encoder, value) in zip(self.encoders,row):
+                parts.append(null if value is None else encoder(value))
+        return b''.join(parts)
+
+class BinaryStream():
+    """Read-only binary file-like object rendering batches of rows from an iterator (such as Connection.stream) in the binary COPY format on demand, the binary counterpart of redshift.CSVStream."""
+    def __init__(self,batches,columns):
+        self.batches = iter(batches)
+        self.encoder = BinaryEncoder(columns)
+        self.buffer = header
+        self.pos = 0
+        self.rows = 0
+        self.finished = False
+
+    def _fill(self):
+        """Encode the next batch into the buffer, or the trailer once the iterator is exhausted.  Return False when there is nothing left."""
+        if self.finished:
+            return False
+        try:
+            batch = next(self.batches)
+            self.buffer = self.encoder.encode(batch)
+            self.rows += len(batch)
+        except StopIteration:
+            self.buffer = trailer
+            self.finished = True
+        self.pos = 0
+        return True
+
+    def read(self,size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.buffer) and not self._fill():
+                break
+            if size < 0:
+                part = self.buffer[self.pos:]
+            else:
+                part = self.buffer[self.pos:self.pos+size]
+                size -= len(part)
+            self.pos += len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+#the reverse of the encoders, so the encoding can be checked against the csv path without a database: python -m action_network_mirror_mirror.pgbinary
+
+def unpacker(fmt):
+    return lambda data: struct.unpack('!' + fmt,data)[0]
+
+def decode_numeric(data):
+    """Decode postgres' binary numeric format, as written by encode_numeric, into a Decimal with the encoded display scale."""
+    (ndigits, weight, sign, dscale) = struct.unpack('!hhHh',data[:8])
+    if sign == 0xC000:
+        return Decimal('NaN')
+    groups = struct.unpack('!%dH' % ndigits,data[8:])
+    value = sum([Decimal(g).scaleb(4 * (weight - i)) for (i, g) in enumerate(groups)],Decimal(0))
+    value = value.quantize(Decimal(1).scaleb(-dscale))
+    return -value if sign == 0x4000 else value
+
+decoders = {
+    'smallint':unpacker('h'),
+    'integer':unpacker('i'),
+    'bigint':unpacker('q'),
+    'real':unpacker('f'),
+    'double precision':unpacker('d'),
+    'boolean':lambda data: data == b'\x01',
+    'character varying':lambda data: data.decode('utf-8'),
+    'character':lambda data: data.decode('utf-8'),
+    'text':lambda data: data.decode('utf-8'),
+    'date':lambda data: pg_epoch_date + timedelta(struct.unpack('!i',data)[0]),
+    'timestamp without time zone':lambda data: pg_epoch + timedelta(microseconds=struct.unpack('!q',data)[0]),
+    'timestamp with time zone':lambda data: pg_epoch_tz + timedelta(microseconds=struct.unpack('!q',data)[0]),
+    'numeric':decode_numeric,
+}
+
+def decode(data,columns):
+    """Decode a complete binary COPY stream, as read from a BinaryStream, into a list of rows of values, with None for nulls."""
+    if not data.startswith(header) or not data.endswith(trailer):
+        raise ValueError('not a complete binary COPY stream')
+    fields = [decoders[col[1]] for col in columns]
+    rows = []
+    pos = len(header)
+    while pos < len(data) - len(trailer):
+        (count,) = struct.unpack('!h',data[pos:pos+2])
+        pos += 2
+        row = []
+        for decoder in fields[:count]:
+            (size,) = struct.unpack('!i',data[pos:pos+4])
+            pos += 4
+            if size < 0:
+                row.append(None)
+                continue
+            row.append(decoder(data[pos:pos+size]))
+            pos += size
+        rows.append(row)
+    return rows
+
+def parse_numeric(text):
+    """Return a numeric field as COPY reads it: exponents are multiplied out, so the display scale is never negative."""
+    value = Decimal(text)
+    if not value.is_finite():
+        return value
+    return value.quantize(Decimal(1).scaleb(min(0,value.as_tuple().exponent)))
+
+#how COPY ... csv reads a field of each type, as far as these checks need
+parsers = {
+    'smallint':int,
+    'integer':int,
+    'bigint':int,
+    'real':float,
+    'double precision':float,
+    'boolean':lambda text: text.lower() in ('t','true'),
+    'date':date.fromisoformat,
+    'timestamp without time zone':datetime.fromisoformat,
+    'timestamp with time zone':datetime.fromisoformat,
+    'numeric':parse_numeric,
+}
+
+def check(rows,columns):
+    """Raise AssertionError unless the binary encoding of some rows decodes to the values COPY would read from their csv rendering by redshift.CSVStream, with '' as null."""
+    from .redshift import CSVStream
+    binary = decode(BinaryStream([rows],columns).read(),columns)
+    text = list(csv.reader(StringIO(CSVStream([rows]).read())))
+    assert len(binary) == len(text) == len(rows), 'row counts differ'
+    for (decoded, fields) in zip(binary,text):
+        for (col, value, field) in zip(columns,decoded,fields):
+            expected = None if field == '' else parsers.get(col[1],str)(field)
+            assert value == expected, '%s: binary gives %r, csv %r' % (col[0],value,expected)
+            if isinstance(value,Decimal) and value.is_finite():
+                assert value.as_tuple().exponent == expected.as_tuple().exponent, '%s: scale of %r differs from csv %r' % (col[0],value,expected)
+
+if __name__ == '__main__':
+    for value in ['0','0.001','1E+5','-99999.9999','12345678.9','-0.5','100.00','NaN']:
+        decoded = decode_numeric(encode_numeric(Decimal(value))[4:])
+        assert str(decoded) == str(parse_numeric(value)), '%s decodes as %s' % (value,decoded)
+    columns = [('id','bigint'),('n','smallint'),('flag','boolean'),('name','character varying'),('amount','numeric'),('ratio','double precision'),
+               ('day','date'),('created_at','timestamp without time zone'),('seen_at','timestamp with time zone')]
+    rows = [
+        (1,-3,True,'plain',Decimal('0.001'),0.1,date(1999,12,31),datetime(2019,6,1,12,30,0,1),datetime(2000,1,1,tzinfo=timezone.utc)),
+        (2**40,0,False,'quote " and, comma\nnewline',Decimal('1E+5'),-2.5e-10,date(2000,1,1),datetime(1970,1,1),datetime(2024,2,29,23,59,59,999999,tzinfo=timezone.utc)),
+        (3,None,None,'',Decimal('-99999.9999'),None,None,None,None),
+        (4,7,True,'ünïcode',Decimal('100.00'),1e300,date(2100,3,1),datetime(2000,1,1),None),
+    ]
+    check(rows,columns)
+    print('binary encoding matches csv for %s rows' % len(rows))
@@ -0,0 +1,46 @@
+from collections import namedtuple
+
+#Segments are tuples so that they can be indexed as the (start_date, end_date, chunk_number) segments used elsewhere.
+#start_id and end_id are None unless a single heavy day has been split by id, and rows is the number of rows expected when the plan was made.
+Segment = namedtuple('Segment',['start','end','num','start_id','end_id','rows'])
+
+def pack(bins,max_chunk):
+    """Greedily combine consecutive (first, last, rows) bins into (first, last, rows) groups of at most max_chunk rows.
+    A bin which is larger than max_chunk on its own is returned as a group of its own."""
+    groups = []
+    for (first, last, rows) in bins:
+        if groups and groups[-1][2] + rows <= max_chunk:
+            groups[-1] = (groups[-1][0], last, groups[-1][2] + rows)
+        else:
+            groups.append((first, last, rows))
+    return groups
+
+def plan_ids(min_id,max_id,max_chunk,histogram,bins=1000):
+    """Return contiguous (start_id, end_id, rows) ranges covering min_id to max_id, each holding at most max_chunk rows.
+    histogram(lo, hi, width) must return the ordered (bucket_start, rows) of the non-empty buckets of ids between lo and hi, where bucket_start = lo + ((id - lo) // width) * width.
+    Ids are assumed to be unique integers, so a bucket no wider than max_chunk can never hold more than max_chunk rows; wider buckets which are too full are re-examined at a finer width."""
+    if min_id is None or max_id is None:
+        return []
+    width = max(1, -(-(max_id - min_id + 1) // bins))
+    found = []
+    for (start, rows) in histogram(min_id,max_id,width):
+        end = min(start + width - 1, max_id)
+        if rows > max_chunk:
+            found.extend(plan_ids(start,end,max_chunk,histogram,bins))
+        else:
+            found.append((start, end, rows))
+    ranges = pack(found,max_chunk)
+    #widen the ranges to meet each other, so that nothing between buckets is left out
+    return [(min_id if i == 0 else ranges[i-1][1] + 1, max_id if i == len(ranges) - 1 else r[1], r[2]) for i, r in enumerate(ranges)]
+
+def plan_dates(day_counts,max_chunk,split_day=None):
+    """Return a list of Segments covering the ordered (day, rows) pairs in day_counts, each expected to hold at most max_chunk rows.
+    Consecutive days are grouped together where they fit.  Days with more than max_chunk rows are passed to split_day(day), which must return (start_id, end_id, rows) ranges such as those made by plan_ids, and get one segment per range.
+    If split_day is None heavy days are left as single oversized segments."""
+    groups = []
+    for (first, last, rows) in pack([(day, day, rows) for (day, rows) in day_counts],max_chunk):
+        if rows > max_chunk and split_day is not None:
+            groups.extend([(first, last, r[0], r[1], r[2]) for r in split_day(first)])
+        else:
+            groups.append((first, last, None, None, rows))
+    return [Segment(g[0], g[1], i + 1, g[2], g[3], g[4]) for i, g in enumerate(groups)]
@@ -1,55 +1,200 @@
-import psycopg2 as pg
 import csv
+import hashlib
 import re
 import pickle
+import os
+import time
+from io import StringIO
 from .local_settings import connection_settings as cs, working_directory as wd
-from .log import log
+from .log import log, timed
+from .connections import get_pool, backoff, connection_errors
+from . import diffsync
+
+#number of rows pulled from a server-side cursor per round trip; this, not the chunk size, bounds the memory used while downloading
+default_fetch_size = 10000
 
 class Connection():
-    def __init__(self):
-        self.conn = pg.connect(dbname = cs['dbname'], host = cs['host'],port=cs['port'],user=cs['user'],password=cs['password'])
+    def __init__(self,settings=None,retries=3):
+        """settings is a dict of connection parameters in the format of local_settings.connection_settings, which is used by default.
+        The connection is leased from the pool shared by all connections with the same settings, and returned to it by close.  retries is how many times fetch reconnects and retries a query after losing the connection."""
+        if settings is None:
+            settings = cs
+        self.pool = get_pool(settings)
+        self.conn = self.pool.getconn()
         self.curs = self.conn.cursor()
         self.logging = True
+        self.cursor_count = 0
+        self.retries = retries
+
+    def reconnect(self):
+        """Discard the current connection and lease another from the pool."""
+        self.pool.putconn(self.conn,broken=True)
+        self.conn = self.pool.getconn()
+        self.curs = self.conn.cursor()
+
+    def recover(self):
+        """Roll back after a failed query, reconnecting if the connection itself was lost, so the next query can run."""
+        try:
+            if not self.conn.closed:
+                self.conn.rollback()
+                return
+        except connection_errors:
+            pass
+        log('lost the connection to %s - reconnecting' % self.pool.settings['host'])
+        self.reconnect()
+
+    def close(self):
+        """Return the connection to the pool."""
+        self.pool.putconn(self.conn)
 
     def fetch(self,query):
-        """Return the full set of data returned by the provided query."""
+        """Return the full set of data returned by the provided query.  If the connection is lost the query is retried on a new one, after a growing delay, up to self.retries times."""
+        attempt = 0
+        while True:
+            try:
+                with timed('query',query=query) as stats:
+                    self.curs.execute(query)
+                    data = self.curs.fetchall()
+                    stats['rows'] = len(data)
+                return data
+            except connection_errors:
+                if not self.conn.closed or attempt == self.retries:
+                    log('error while executing query %s' %query)
+                    raise
+                attempt += 1
+                delay = backoff(attempt)
+                log('lost the connection while executing query %s - retrying in %.1fs' % (query,delay))
+                time.sleep(delay)
+                self.reconnect()
+            except:
+                log('error while executing query %s' %query)
+                raise
+
+    def stream(self,query,fetch_size=default_fetch_size):
+        """Yield the data returned by the provided query in batches of at most fetch_size rows.  Uses a named (server-side) cursor so the full result set is never held in memory.
+        The cursor is closed however iteration ends, including when the consumer stops early."""
+        self.cursor_count += 1
+        curs = self.conn.cursor(name='stream_%s' % self.cursor_count)
         try:
-            self.curs.execute(query)
-            return self.curs.fetchall()
-        except:
-            log('error while executing query %s' %query)
+            curs.execute(query)
+            while True:
+                batch = curs.fetchmany(fetch_size)
+                if not batch:
+                    break
+                yield batch
+        except Exception:
+            log('error while streaming query %s' %query)
+            close_cursor(curs)
+            self.recover()
             raise
-    
+        finally:
+            close_cursor(curs)
+
+def close_cursor(curs):
+    """Close a cursor, ignoring errors from a connection which has already failed."""
+    try:
+        curs.close()
+    except Exception:
+        pass
+
+class CSVStream():
+    """Read-only file-like object rendering batches of rows from an iterator (such as Connection.stream) as csv text on demand.
+    Only one batch is buffered at a time, so it can be passed to copy_expert to pipe a query result into another database with bounded memory."""
+    def __init__(self,batches):
+        self.batches = iter(batches)
+        self.buffer = ''
+        self.pos = 0
+        self.rows = 0
+
+    def _fill(self):
+        """Render the next batch into the buffer.  Return False once the iterator is exhausted."""
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            return False
+        out = StringIO()
+        csv.writer(out,lineterminator='\n').writerows(batch)
+        self.buffer = out.getvalue()
+        self.pos = 0
+        self.rows += len(batch)
+        return True
+
+    def read(self,size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.buffer) and not self._fill():
+                break
+            if size < 0:
+                part = self.buffer[self.pos:]
+            else:
+                part = self.buffer[self.pos:self.pos+size]
+                size -= len(part)
+            self.pos += len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def readline(self):
+        if self.pos >= len(self.buffer) and not self._fill():
+            return ''
+        end = self.buffer.find('\n',self.pos)
+        end = len(self.buffer) if end == -1 else end + 1
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        return line
+
+#the information_schema.columns fields making up the schema fingerprint, in the order they are joined for hashing
+fingerprint_columns = ['table_name','column_name','data_type','ordinal_position','character_maximum_length','numeric_precision','numeric_precision_radix']
+
+def schema_fingerprint(cols):
+    """Return the fingerprint Redshift_Data_Model.fingerprint computes on the server, from rows of fingerprint_columns already fetched."""
+    total = 0
+    for row in cols:
+        text = '|'.join(['' if v is None else str(v) for v in row])
+        total += int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8],16)
+    return (len(cols), total)
+
 class Redshift_Data_Model():
     """Class for containing a representation of the table structure of the redshift database, and providing useful representations of the data."""
     
-    fname = 'data_model.json'
+    fname = 'data_model.pickle'
     
-    def __init__(self,refresh=True):
-        self.db = Connection()
-        if not refresh:
-            try:
-                self.load()
-            except FileNotFoundError:
-                self.refresh()
-        else:
+    def __init__(self,refresh=True,settings=None):
+        """settings, if given, are the connection parameters of a database other than the usual redshift source, whose model is then saved under a name of its own."""
+        self.db = Connection(settings)
+        if settings is not None:
+            self.fname = 'data_model_%s_%s.pickle' % (settings['host'],settings['dbname'])
+        if refresh or not self.load():
             self.refresh()
                 
     def load(self):
-        """Populate the data model from a local saved copy. Currently out of service due to switching to a custom dict class."""
-        pass
-        #with open(wd + self.fname,'rt') as src:
-        #    j = json.load(src)
-        #self.model = j
-    
+        """Populate the data model from the local copy saved by the last refresh.  Return False, leaving the model unpopulated, if there is no saved copy or if the schema fingerprint no longer matches the redshift database."""
+        try:
+            with open(wd + self.fname,'rb') as src:
+                (fingerprint, model) = pickle.load(src)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False
+        if fingerprint != self.fingerprint():
+            log('redshift schema has changed since the data model was saved')
+            return False
+        self.model = model
+        return True
+
+    def fingerprint(self):
+        """Return the (count, hash sum) fingerprint of the column definitions in the information_schema of the redshift database, which changes whenever a table or column is added, dropped, renamed, retyped or reordered.
+        It is computed on the server, so checking a saved model costs a single row rather than the whole catalog."""
+        text = " || '|' || ".join(["coalesce(cast(%s as varchar),'')" % col for col in fingerprint_columns])
+        (count, total) = self.db.fetch("SELECT count(1), sum(%s) FROM information_schema.columns WHERE table_schema = 'group_64154_indexed'" % (diffsync.hash_expressions['redshift'] % text))[0]
+        return (int(count), int(total or 0))
     
     def refresh(self):
         """Populate the data model based on the information_schema of the redshift database.
         The self.model atribute is a dictionary of table classes in the primary schema, with each record containing a tuple of which the first item is a list of all table names belonging to that class, and the second is
-        a list of tuples containing the names and datatype attributes of the columns in that class of table.  Columns are listed according to their ordinal position."""
+        a list of tuples containing the names and datatype attributes of the columns in that class of table.  Columns are listed according to their ordinal position.
+        A copy is saved locally, along with the schema fingerprint, for later retrieval by load."""
         
         tables = self.db.fetch("SELECT table_name FROM information_schema.tables WHERE table_schema = 'group_64154_indexed' ORDER BY table_name")
         cols = self.db.fetch("SELECT table_name, ordinal_position, column_name, data_type, character_maximum_length, numeric_precision, numeric_precision_radix FROM information_schema.columns WHERE table_schema = 'group_64154_indexed' ORDER BY table_name, ordinal_position")
+        fingerprint = schema_fingerprint([(row[0],row[2],row[3],row[1],row[4],row[5],row[6]) for row in cols])
         tables = [row[0] for row in tables]
         self.model = ModelDict()
         pat = re.compile('(.*)_\d+')
@@ -68,9 +213,10 @@ class Redshift_Data_Model():
                 self.model[table][1].append((col_name,data_type,char_len,num_precision, num_radix))
                 self.model[table][2][col_name] = (col_name,data_type,char_len,num_precision, num_radix)
 
-        #save a copy for later retrieval
-        #with open(wd + self.fname,'wt') as sink:
-        #    json.dump(self.model,sink)
+        #save a copy for later retrieval, replacing any previous copy in one step so concurrent readers never see a partial file
+        with open(wd + self.fname + '.tmp','wb') as sink:
+            pickle.dump((fingerprint,self.model),sink)
+        os.replace(wd + self.fname + '.tmp',wd + self.fname)
 
     def list_tables(self):
         """list all table classes present in the database"""
@@ -80,6 +226,10 @@ class Redshift_Data_Model():
         """List the names of all columns in a chosen table."""
         return [col[0] for col in self.model[table][1]]
     
+    def list_col_tuples(self,table):
+        """List the (col_name, data_type, char_len, num_precision, num_radix) tuples of all columns in a chosen table, in the order select_statement pulls them."""
+        return self.model[table][1]
+
     def get_col_tuple(self,table,column):
         return self.model[table][2][column]
 
@@ -90,13 +240,15 @@ class Redshift_Data_Model():
     def master_table(self,subtable):
         return self.model.subtables[subtable]
 
-    def create_statement(self,table,schema=None):
-        """Return a psql create statement for the table class provided in the table parameter.  Tables are created without primary keys."""
+    def create_statement(self,table,schema=None,name=None):
+        """Return a psql create statement for the table class provided in the table parameter, optionally creating it under a different name.  Tables are created without primary keys."""
         cols = self.model[table][1]
+        if name is None:
+            name = table
         if schema is None:
-            statement = 'CREATE TABLE %s (' % table + ', '.join([describe_field(col) for col in cols]) + ');'
+            statement = 'CREATE TABLE %s (' % name + ', '.join([describe_field(col) for col in cols]) + ');'
         else:
-            statement = 'CREATE TABLE %s.%s (' % (schema,table) + ', '.join([describe_field(col) for col in cols]) + ');'
+            statement = 'CREATE TABLE %s.%s (' % (schema,name) + ', '.join([describe_field(col) for col in cols]) + ');'
         return statement
 
     def select_statement(self,table):
@@ -105,10 +257,12 @@ class Redshift_Data_Model():
         statement = "SELECT " + ', '.join([dereserve(col[0]) for col in cols]) + " FROM " + table
         return statement
 
-    def select_statement_by_dates(self,table,start_date,end_date,date_field='created_at'):
-        """Return a select statement with a WHERE clause restricting to values with a created_at field between the start_date and end_dates provided (as python date objects)."""
+    def select_statement_by_dates(self,table,start_date,end_date,date_field='created_at',condition=None):
+        """Return a select statement with a WHERE clause restricting to values with a created_at field between the start_date and end_dates provided (as python date objects), and meeting the additional SQL condition if one is provided."""
         statement = self.select_statement(table)
         statement += " WHERE trunc(%s) BETWEEN '%s' AND '%s'" % (date_field,start_date.isoformat(), end_date.isoformat())
+        if condition:
+            statement += " AND %s" % condition
         return statement
         
     def select_statement_by_ids(self,table,start_id,end_id):
@@ -140,10 +294,15 @@ class ModelDict(dict):
         except KeyError:
             return super().__getitem__(self.subtables[key])
     
+def renamed(colname):
+    """Return the name a column is given in the upload database, where reserved words are prefixed with r_."""
+    if colname.upper() in reserved_words:
+        return 'r_'+colname
+    return colname
+
 def describe_field(field_tuple):
     (col_name,data_type,char_len,num_precision, num_radix) = field_tuple
-    if col_name.upper() in reserved_words:
-        col_name = 'r_'+col_name
+    col_name = renamed(col_name)
     if data_type == 'character varying':
         description = '%s %s (%s)' % (col_name, data_type, char_len)
     else:
@@ -0,0 +1,93 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from .local_settings import working_directory as wd
+from .log import log
+from .jsonfile import JSONFile
+
+#estimated seconds for a table with no history, and how many past runs of each table are kept
+default_estimate = 600.0
+history_length = 10
+
+#a table placed in a plan, with its estimated seconds, how long since it was last synced (None if never), and its expected start and finish
+Planned = namedtuple('Planned',['table','estimate','staleness','start','finish'])
+
+class History():
+    """Persisted statistics of past syncs, saved as json in the working directory.  For each job (such as 'download_all') and table this keeps the finish time, duration and row count of its last few runs."""
+
+    fname = 'history.json'
+
+    def __init__(self,wd=wd):
+        self.path = wd + self.fname
+        self.data_file = JSONFile(self.path)
+
+    def record(self,table,seconds,rows=None,job='download_all',succeeded=True):
+        """Add a run of a job on a table to the history, dropping the oldest runs beyond history_length."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+            runs = data.setdefault(job,{}).setdefault(table,[])
+            runs.append({'finished':datetime.now().isoformat(),'seconds':round(seconds,3),'rows':rows,'succeeded':succeeded})
+            del runs[:-history_length]
+            self.data_file.write(data)
+
+    def runs(self,table,job='download_all'):
+        with self.data_file.lock:
+            return self.data_file.read().get(job,{}).get(table,[])
+
+    def estimate(self,table,job='download_all'):
+        """Return the expected seconds for a job on a table: the median duration of its recent successful runs, or None if it has none."""
+        durations = sorted([r['seconds'] for r in self.runs(table,job) if r['succeeded']])
+        if not durations:
+            return None
+        return durations[len(durations) // 2]
+
+    def last_success(self,table,job='download_all'):
+        """Return when a job last succeeded on a table, or None if it never has."""
+        finished = [r['finished'] for r in self.runs(table,job) if r['succeeded']]
+        if not finished:
+            return None
+        return datetime.fromisoformat(max(finished))
+
+def plan(tables,estimates,last_synced,now=None,budget=None,deadline=None,priorities=None):
+    """Order tables so that those which are most overdue for their cost run first, and pack them into the time available.
+    estimates maps each table to its expected seconds (None where unknown, for which the median of the known estimates is used), and last_synced to when it was last synced (None if never; these come first).
+    Each table's urgency is its staleness in hours times its priority (1 unless given in priorities), and tables are taken in decreasing order of urgency per second of estimated cost.
+    If a budget (a timedelta) or deadline (a datetime) is given, tables which would not finish in time are deferred, while cheaper tables after them may still fit.  Return (scheduled, deferred) lists of Planned."""
+    now = now or datetime.now()
+    priorities = priorities or {}
+    known = sorted([e for e in estimates.values() if e is not None])
+    fallback = known[len(known) // 2] if known else default_estimate
+    limit = None
+    if budget is not None:
+        limit = now + budget
+    if deadline is not None:
+        limit = deadline if limit is None else min(limit,deadline)
+    def staleness(table):
+        synced = last_synced.get(table)
+        return None if synced is None else now - synced
+    def order(table):
+        cost = estimates.get(table) or fallback
+        stale = staleness(table)
+        if stale is None:
+            return (0, cost)
+        return (1, -(stale.total_seconds() / 3600.0) * priorities.get(table,1) / max(cost,1.0))
+    scheduled = []
+    deferred = []
+    clock = now
+    for table in sorted(tables,key=order):
+        cost = estimates.get(table) or fallback
+        finish = clock + timedelta(seconds=cost)
+        if limit is not None and finish > limit:
+            deferred.append(Planned(table,cost,staleness(table),None,None))
+            continue
+        scheduled.append(Planned(table,cost,staleness(table),clock,finish))
+        clock = finish
+    return (scheduled, deferred)
+
+def describe(scheduled,deferred):
+    """Log a plan as made by plan, with each table's expected start and finish and the expected finish of the whole."""
+    for p in scheduled:
+        log('%s: %s to %s (estimated %.0fs, last synced %s)' % (p.table,p.start.strftime('%H:%M:%S'),p.finish.strftime('%H:%M:%S'),p.estimate,'never' if p.staleness is None else '%s ago' % p.staleness))
+    if deferred:
+        log('deferred as they would not fit: ' + ', '.join(['%s (estimated %.0fs)' % (p.table,p.estimate) for p in deferred]))
+    if scheduled:
+        log('expected to finish at %s' % scheduled[-1].finish.isoformat(sep=' ',timespec='seconds'))
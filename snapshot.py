@@ -0,0 +1,166 @@
+import os
+from datetime import datetime, date, time, timedelta
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+from .local_settings import working_directory as wd
+from .chunkfile import strip_suffix
+from .log import log
+from .jsonfile import JSONFile
+
+#columns whose range within each partition is kept in the index, so restores can pick out the partitions they need
+ranged = ['id','created_at','updated_at']
+#rows per batch when reading partitions back
+read_batch_size = 10000
+
+def arrow_type(data_type):
+    """Return the arrow type for a column of the given information_schema data_type.  numeric is kept as text, as the model does not record its scale, and so are any types without an equivalent."""
+    return {
+        'smallint':pa.int16(),
+        'integer':pa.int32(),
+        'bigint':pa.int64(),
+        'real':pa.float32(),
+        'double precision':pa.float64(),
+        'boolean':pa.bool_(),
+        'date':pa.date32(),
+        'timestamp without time zone':pa.timestamp('us'),
+        'timestamp with time zone':pa.timestamp('us',tz='UTC'),
+    }.get(data_type,pa.string())
+
+def schema_for(columns):
+    """Return the arrow schema for the model's column tuples (col_name, data_type, char_len, num_precision, num_radix)."""
+    return pa.schema([(col[0],arrow_type(col[1])) for col in columns])
+
+class SnapshotStore():
+    """Durable local copy of downloaded tables as parquet partitions, one per chunk downloaded, kept under snapshots/ in the working directory with a json index of each partition's rows and id and date ranges.
+    A full download of a (sub)table supersedes its earlier partitions once it completes, while incremental downloads add partitions alongside them.  Requires pyarrow."""
+
+    dirname = 'snapshots/'
+    fname = 'index.json'
+
+    def __init__(self,wd=wd):
+        if pa is None:
+            raise ImportError('the pyarrow package is required to keep snapshots')
+        self.dir = wd + self.dirname
+        self.path = self.dir + self.fname
+        self.data_file = JSONFile(self.path)
+        os.makedirs(self.dir,exist_ok=True)
+
+    def writer(self,table,chunk,columns):
+        """Return a SnapshotWriter for a new partition of a (sub)table holding the rows downloaded into the named chunk file."""
+        return SnapshotWriter(self,table,chunk,columns)
+
+    def record(self,table,partition):
+        with self.data_file.lock:
+            data = self.data_file.read()
+            data.setdefault(table,{}).setdefault('partitions',[]).append(partition)
+            self.data_file.write(data)
+
+    def begin(self,table,save_as):
+        """Note that a full download of a table, saved as save_as, has started; once complete is called for it, it supersedes all partitions written before now."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+            data.setdefault(table,{})['pending'] = {'save_as':save_as,'started':datetime.now().isoformat()}
+            self.data_file.write(data)
+
+    def complete(self,table,save_as):
+        """Retire the partitions superseded by a finished full download of a table.  Does nothing unless a full download saved as save_as is pending."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+            entry = data.get(table,{})
+            pending = entry.get('pending')
+            if pending is None or pending['save_as'] != save_as:
+                return
+            retired = [p for p in entry.get('partitions',[]) if p['written'] < pending['started']]
+            entry['partitions'] = [p for p in entry.get('partitions',[]) if p['written'] >= pending['started']]
+            del entry['pending']
+            self.data_file.write(data)
+        for p in retired:
+            try:
+                os.remove(self.dir + p['file'])
+            except FileNotFoundError:
+                pass
+        log('snapshot of %s complete - retired %s earlier partitions' % (table,len(retired)))
+
+    def partitions(self,table,start_date=None,end_date=None,date_field='created_at',start_id=None,end_id=None):
+        """Return the index entries of the partitions of a table in the order they were written, leaving out any which the index shows to hold no rows with date_field between start_date and end_date or ids between start_id and end_id."""
+        with self.data_file.lock:
+            found = self.data_file.read().get(table,{}).get('partitions',[])
+        def overlaps(p,column,lo,hi):
+            r = p['ranges'].get(column)
+            if r is None or r[0] is None:
+                return True
+            return (hi is None or r[0] <= hi) and (lo is None or r[1] >= lo)
+        if start_date is not None or end_date is not None:
+            lo = start_date.isoformat() if start_date else None
+            hi = (end_date + timedelta(1)).isoformat() if end_date else None
+            found = [p for p in found if overlaps(p,date_field,lo,hi)]
+        if start_id is not None or end_id is not None:
+            found = [p for p in found if overlaps(p,'id',start_id,end_id)]
+        return sorted(found,key=lambda p: p['written'])
+
+    def read(self,partition,start_date=None,end_date=None,date_field='created_at',start_id=None,end_id=None):
+        """Yield the rows of a partition, restricted to date_field between start_date and end_date and ids between start_id and end_id where given, in batches of tuples in model column order."""
+        filters = []
+        if start_date is not None:
+            filters.append((date_field,'>=',datetime.combine(start_date,time())))
+        if end_date is not None:
+            filters.append((date_field,'<',datetime.combine(end_date + timedelta(1),time())))
+        if start_id is not None:
+            filters.append(('id','>=',start_id))
+        if end_id is not None:
+            filters.append(('id','<=',end_id))
+        data = pq.read_table(self.dir + partition['file'],filters=filters or None)
+        for batch in data.to_batches(max_chunksize=read_batch_size):
+            yield list(zip(*[column.to_pylist() for column in batch.columns]))
+
+class SnapshotWriter():
+    """Writes batches of downloaded rows to a new parquet partition, which only appears in the index once commit is called."""
+    def __init__(self,store,table,chunk,columns):
+        self.store = store
+        self.table = table
+        self.chunk = chunk
+        self.schema = schema_for(columns)
+        self.text = [arrow_type(col[1]) == pa.string() for col in columns]
+        names = [col[0] for col in columns]
+        self.ranged = [(name, names.index(name)) for name in ranged if name in names]
+        self.ranges = {}
+        self.rows = 0
+        os.makedirs(store.dir + table,exist_ok=True)
+        self.file = '%s/%s_%s.parquet' % (table,strip_suffix(chunk),datetime.now().strftime('%Y%m%dT%H%M%S%f'))
+        self.sink = pq.ParquetWriter(store.dir + self.file + '.tmp',self.schema,compression='zstd')
+
+    def write(self,batch):
+        if not batch:
+            return
+        columns = list(zip(*batch))
+        arrays = []
+        for (i, values) in enumerate(columns):
+            if self.text[i]:
+                values = [None if v is None else str(v) for v in values]
+            arrays.append(pa.array(values,type=self.schema.field(i).type))
+        self.sink.write_table(pa.Table.from_arrays(arrays,schema=self.schema))
+        self.rows += len(batch)
+        for (name, i) in self.ranged:
+            values = [v for v in columns[i] if v is not None]
+            if not values:
+                continue
+            (lo, hi) = self.ranges.get(name,(min(values),max(values)))
+            self.ranges[name] = (min(lo,min(values)),max(hi,max(values)))
+
+    def commit(self):
+        """Finish the partition and add it to the index."""
+        self.sink.close()
+        os.replace(self.store.dir + self.file + '.tmp',self.store.dir + self.file)
+        ranges = dict([(name, [v.isoformat() if isinstance(v,date) else v for v in r]) for (name, r) in self.ranges.items()])
+        self.store.record(self.table,{'file':self.file,'chunk':self.chunk,'rows':self.rows,'ranges':ranges,'written':datetime.now().isoformat()})
+
+    def abort(self):
+        """Discard the partition, after a failed download."""
+        try:
+            self.sink.close()
+        finally:
+            if os.path.exists(self.store.dir + self.file + '.tmp'):
+                os.remove(self.store.dir + self.file + '.tmp')
@@ -1,38 +1,111 @@
-import psycopg2 as pg
+import os
 from .local_settings import upbound_connection as uc, working_directory as wd
-from .log import log
+from .log import log, timed
+from .connections import get_pool, connection_errors
+from .chunkfile import open_chunk
 
+#COPY options for csv chunks and for streams encoded by pgbinary
+csv_format = "csv encoding 'utf-8'"
+binary_format = "(FORMAT binary)"
 
 class Uploader():
-    def __init__(self):
+    def __init__(self,settings=None):
+        """settings is a dict of connection parameters in the format of local_settings.upbound_connection, which is used by default.  The connection is leased from the pool shared by all connections with the same settings."""
+        self.settings = uc if settings is None else settings
+        self.pool = get_pool(self.settings)
         self.db_connect()
         
     def db_connect(self):
-        self.connection = pg.connect(dbname = uc['dbname'], host = uc['host'],port=uc['port'],user=uc['user'],password=uc['password'])
+        self.connection = self.pool.getconn()
         self.curs = self.connection.cursor()
+
+    def reconnect(self):
+        """Discard the current connection and lease another from the pool."""
+        self.pool.putconn(self.connection,broken=True)
+        self.db_connect()
+
+    def recover(self):
+        """Roll back after a failed statement, reconnecting if the connection itself was lost, so the next statement can run."""
+        try:
+            if not self.connection.closed:
+                self.connection.rollback()
+                return
+        except connection_errors:
+            pass
+        log('lost the connection to the upload database - reconnecting')
+        self.reconnect()
+
+    def _copy(self,fname,schema,destination,wd=wd):
+        """For internal usage.  COPY a chunk file into a table, recording the time, rows and bytes as a copy event."""
+        with timed('copy',destination,fname) as stats:
+            with open_chunk(wd+fname,'rt') as src:
+                self.curs.copy_expert("COPY %s.%s FROM STDIN %s" % (schema,destination,csv_format),src)
+            stats['rows'] = self.curs.rowcount
+            stats['bytes'] = os.path.getsize(wd+fname)
+
+    def _merge(self,merge_func,destination,chunk=None):
+        """For internal usage.  Merge redshift_staging into redshift using the named database function and commit, recording the time as a merge event."""
+        with timed('merge',destination,chunk):
+            self.curs.execute("SELECT %s('%s');" % (merge_func,destination))
+            self.connection.commit()
         
     def upload_file(self,fname,destination,wd=wd):
-        with open(wd+fname,'rt',encoding='utf-8') as src:
-            log('uploading %s to %s' % (fname, destination))
-            self.curs.copy_expert("COPY redshift.%s FROM STDIN csv encoding 'utf-8'" % destination,src)
+        log('uploading %s to %s' % (fname, destination))
+        self._copy(fname,'redshift',destination,wd=wd)
             
     def upload_limited(self,fname,destination,wd=wd):
-        with open(wd+fname,'rt',encoding='utf-8') as src:
-            log( 'uploading %s to %s - partial upload' % (fname, destination))
-            self.curs.copy_expert("COPY redshift_staging.%s FROM STDIN csv encoding 'utf-8'" % destination,src)
-            self.curs.execute("SELECT update_from_staging('%s');" % destination)
-            self.connection.commit()
+        log( 'uploading %s to %s - partial upload' % (fname, destination))
+        self._copy(fname,'redshift_staging',destination,wd=wd)
+        self._merge('update_from_staging',destination,fname)
             
     def upload_limited_mutable(self,fname,destination,wd=wd):
-        with open(wd+fname,'rt',encoding='utf-8') as src:
-            log( 'uploading %s to %s - partial upload - mutable' % (fname, destination))
-            self.curs.copy_expert("COPY redshift_staging.%s FROM STDIN csv encoding 'utf-8'" % destination,src)
-            self.curs.execute("SELECT update_mutable_from_staging('%s');" % destination)
-            self.connection.commit()
+        log( 'uploading %s to %s - partial upload - mutable' % (fname, destination))
+        self._copy(fname,'redshift_staging',destination,wd=wd)
+        self._merge('update_mutable_from_staging',destination,fname)
     
     def upload_limited_nodate(self,fname,destination,wd=wd):
-        with open(wd+fname,'rt',encoding='utf-8') as src:
-            log( 'uploading %s to %s - partial upload' % (fname, destination))
-            self.curs.copy_expert("COPY redshift_staging.%s FROM STDIN csv encoding 'utf-8'" % destination,src)
-            self.curs.execute("SELECT update_nodate_from_staging('%s');" % destination)
-            self.connection.commit()
\ No newline at end of file
+        log( 'uploading %s to %s - partial upload' % (fname, destination))
+        self._copy(fname,'redshift_staging',destination,wd=wd)
+        self._merge('update_nodate_from_staging',destination,fname)
+
+    def upload_batch(self,fnames,destination,merge_func,wd=wd):
+        """COPY several chunk files into redshift_staging and merge them into redshift with a single call of the named merge function and a single commit.  Nothing is committed if any of them fails to load."""
+        log('uploading %s files to %s - batched partial upload via %s' % (len(fnames),destination,merge_func))
+        try:
+            for fname in fnames:
+                self._copy(fname,'redshift_staging',destination,wd=wd)
+            self._merge(merge_func,destination,'%s files' % len(fnames))
+        except:
+            self.recover()
+            raise
+
+    def upload_stream(self,src,destination,merge_func=None,binary=False):
+        """COPY csv data from a file-like object (such as a redshift.CSVStream) without touching disk.  If merge_func is given the data is loaded into redshift_staging and merged with that function, otherwise it is copied directly into redshift.
+        If binary is True src must give binary COPY data instead, as a pgbinary.BinaryStream does."""
+        schema = 'redshift' if merge_func is None else 'redshift_staging'
+        if merge_func is None:
+            log('streaming to %s' % destination)
+        else:
+            log('streaming to %s - partial upload via %s' % (destination, merge_func))
+        with timed('transfer',destination) as stats:
+            self.curs.copy_expert("COPY %s.%s FROM STDIN %s" % (schema,destination,binary_format if binary else csv_format),src)
+            stats['rows'] = self.curs.rowcount
+        if merge_func is None:
+            self.connection.commit()
+        else:
+            self._merge(merge_func,destination)
+
+    def replace_range(self,destination,start_id,end_id,sources,binary=False):
+        """Replace the rows of redshift.destination with ids between start_id and end_id by the csv data (or binary COPY data, if binary is True) read from each of the file-like sources, in a single transaction."""
+        log('replacing ids %s to %s of %s' % (start_id,end_id,destination))
+        try:
+            with timed('transfer',destination,'%s-%s' % (start_id,end_id)) as stats:
+                self.curs.execute('DELETE FROM redshift.%s WHERE id BETWEEN %s AND %s' % (destination,start_id,end_id))
+                stats['rows'] = 0
+                for src in sources:
+                    self.curs.copy_expert("COPY redshift.%s FROM STDIN %s" % (destination,binary_format if binary else csv_format),src)
+                    stats['rows'] += self.curs.rowcount
+                self.connection.commit()
+        except:
+            self.recover()
+            raise
@@ -0,0 +1,64 @@
+import threading
+from datetime import datetime, timedelta
+from .local_settings import working_directory as wd
+from .jsonfile import JSONFile
+
+class Watermarks():
+    """Persisted high-water marks for incremental syncs, saved as json in the working directory.
+    For each (sub)table this records the date field used and the exact (timestamp, id) of the last row loaded into the upload database,
+    plus a pending mark for rows which have been downloaded but not yet uploaded.  The pending mark is promoted once the upload has committed."""
+
+    fname = 'watermarks.json'
+
+    def __init__(self,wd=wd):
+        self.path = wd + self.fname
+        self.data_file = JSONFile(self.path)
+
+    def get(self,table):
+        """Return the (date_field, timestamp, id) of the last row of a table known to be loaded, or None if the table has no watermark."""
+        with self.data_file.lock:
+            mark = self.data_file.read().get(table,{}).get('loaded')
+        if mark is None:
+            return None
+        return (mark['date_field'], datetime.fromisoformat(mark['timestamp']), mark['id'])
+
+    def set_pending(self,table,date_field,mark):
+        """Record the (timestamp, id) of the last row downloaded for a table, to become its watermark once uploaded."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+            data.setdefault(table,{})['pending'] = {'date_field':date_field,'timestamp':mark[0].isoformat(),'id':mark[1]}
+            self.data_file.write(data)
+
+    def promote(self,table):
+        """Make the pending mark of a table its watermark.  Does nothing if there is no pending mark."""
+        with self.data_file.lock:
+            data = self.data_file.read()
+            try:
+                data[table]['loaded'] = data[table].pop('pending')
+            except KeyError:
+                return
+            self.data_file.write(data)
+
+    def condition(self,table,overlap=timedelta(0)):
+        """Return a SQL condition selecting the rows of a table past its watermark.  If overlap is non-zero, rows up to that long before the watermark are selected again as a safety margin."""
+        (date_field, timestamp, last_id) = self.get(table)
+        if overlap:
+            return "%s >= '%s'" % (date_field,(timestamp - overlap).isoformat(sep=' '))
+        return "(%s > '%s' OR (%s = '%s' AND id > %s))" % (date_field,timestamp.isoformat(sep=' '),date_field,timestamp.isoformat(sep=' '),last_id)
+
+class HighWater():
+    """Accumulator for the greatest (date, id) key among batches of rows passed to update.  date_index and id_index give the positions of those columns in each row."""
+    def __init__(self,date_index,id_index):
+        self.date_index = date_index
+        self.id_index = id_index
+        self.mark = None
+        self.lock = threading.Lock()
+
+    def update(self,batch):
+        keys = [(row[self.date_index], row[self.id_index]) for row in batch if row[self.date_index] is not None and row[self.id_index] is not None]
+        if not keys:
+            return
+        top = max(keys)
+        with self.lock:
+            if self.mark is None or top > self.mark:
+                self.mark = top